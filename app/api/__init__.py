@@ -1,2 +1,2 @@
-from ..app import app, HOLIDAYS
+from ..app import app, TZ, HOLIDAYS
 from . import autotriage, dashboard, desks, ffs, physician_scheduler, request_detail, triage_history
\ No newline at end of file
@@ -1,62 +1,39 @@
+import asyncio
+import logging
 import re
+from contextlib import suppress
+from os import environ
 from typing import LiteralString
 from quart import request
 from werkzeug.exceptions import BadRequest
 from psycopg.rows import dict_row
 from .error import ApiError
+from .referral_notes import fetch_notes, ReferralNote, EMPTY_NOTE
+from .labels import labels
 from . import app
-from ..database import comrad_pool, local_pool
+from ..database import comrad_pool, local_pool, triage_log
 
 
 referral_data_query: LiteralString = r"""
 select
+distinct on (rf_serial)
+rf_serial referral,
 rf_exam_type modality,
-case
-    when xpath_exists('//p[@id="EXAMREQUESTED"]',doc) then
-        substring((xpath('//p[@id="EXAMREQUESTED"]/text()', doc))[1]::text, 3)
-    when xpath_exists('//p[b[text()="Reason For Study:"]]',doc) then
-        substring((xpath('//p[b[text()="Reason For Study:"]]/text()',doc))[1]::text, 2)
-    end requested_exam,
 rf_reason normalised_exam,
 extract(YEAR from age(pa_dob))::int patient_age,
-substring((xpath('//p[@id="EGFRRESULT"]/text()', doc))[1]::text from '(\d+) mL/min/1.73m2')::int egfr
+no_serial note
 from case_referral
 join patient on rf_pno = pa_pno
-left join (
-    select no_key,
-    XMLPARSE(document te_text) doc
-    from notes
-    left join doctext on te_key = no_serial and te_key_type = 'N' and xml_is_well_formed_document(te_text)
-    where no_type = 'F' and no_category = 'Q' and no_sub_category = 'R' and no_status = 'A'
-) xml on no_key = rf_serial
-where rf_serial=%s
+left join notes on no_key = rf_serial and no_type = 'F' and no_category = 'Q' and no_sub_category = 'R' and no_status = 'A'
+where rf_serial = any(%s)
+order by rf_serial, no_serial
 """
 
-autotriage_query: LiteralString = r"""
-select
-examination.code,
-name as exam,
-body_part,
-coalesce(username=%s, false) as custom
-from label
-join examination on label.code=examination.code and label.modality=examination.modality
-where tokenised=%s and label.modality=%s
-order by custom desc, username is not null
-limit 1
-"""
+MAX_BATCH = 500
 
-autotriage_log_query: LiteralString = r"""
-insert into triage_log (
-    username,
-    version,
-    modality,
-    referral,
-    requested_exam,
-    normalised_exam,
-    tokenised,
-    code
-) values (%s, %s, %s, %s, %s, %s, %s, %s)
-"""
+# Labels load at startup without holding it up for long; if the local database is down they are retried in the background
+LABELS_STARTUP_TIMEOUT = float(environ.get('AUTOTRIAGE_LABELS_STARTUP_TIMEOUT', 5))
+LABELS_RETRY_SECONDS = float(environ.get('AUTOTRIAGE_LABELS_RETRY_SECONDS', 30))
 
 remember_autotriage_query: LiteralString = r"""
 insert into label (username, modality, tokenised, code)
@@ -65,6 +42,94 @@ on conflict (tokenised, modality, username) do update
 set code = excluded.code
 """
 
+labels_loader: asyncio.Task | None = None
+
+async def retry_load_labels():
+    while True:
+        await asyncio.sleep(LABELS_RETRY_SECONDS)
+        try:
+            async with local_pool.connection() as conn:
+                await labels.load(conn)
+            return
+        except Exception:
+            logging.exception('Error loading autotriage labels, retrying')
+
+@app.before_serving
+async def load_labels():
+    global labels_loader
+    try:
+        async with local_pool.connection(timeout=LABELS_STARTUP_TIMEOUT) as conn:
+            await labels.load(conn)
+    except Exception:
+        logging.exception('Autotriage labels unavailable at startup, retrying in the background')
+        labels_loader = asyncio.create_task(retry_load_labels(), name='Autotriage labels')
+
+@app.after_serving
+async def stop_labels_loader():
+    if labels_loader is not None:
+        labels_loader.cancel()
+        with suppress(asyncio.CancelledError):
+            await labels_loader
+
+async def fetch_referrals(referrals: list[int]) -> dict[int, tuple[dict, ReferralNote]]:
+    async with comrad_pool.connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(referral_data_query, [referrals], prepare=True)
+            rows = await cur.fetchall()
+        notes = await fetch_notes(conn, (row['note'] for row in rows))
+    return {row['referral']: (row, notes.get(row['note'], EMPTY_NOTE)) for row in rows}
+
+def autotriage(user_code: str, version, referral: int, data: dict, note: ReferralNote) -> tuple[dict, list]:
+    """Suggested examination for one referral, and its triage_log row."""
+    modality = data['modality']
+    requested_exam = note.requested_exam
+    normalised_exam = data['normalised_exam']
+    patient_age = data['patient_age']
+    egfr = note.egfr
+    tokenised = tokenise_request(requested_exam) if requested_exam is not None else tokenise_request(normalised_exam)
+    label = labels.lookup(user_code, tokenised, modality)
+    if label is None and requested_exam is not None:
+        label = labels.lookup(user_code, tokenise_request(normalised_exam), modality)
+    match_type = 'exact'
+    if label is None:
+        match_type = 'approximate'
+        label = labels.approximate(user_code, tokenised, modality)
+        if label is None and requested_exam is not None:
+            label = labels.approximate(user_code, tokenise_request(normalised_exam), modality)
+    if label is not None:
+        code = label.code
+        if code in ('Q25', 'Q25C') and (patient_age >= 80 or egfr is not None and egfr < 30):
+            code = 'Q25TC' if code == 'Q25C' else 'Q25T' # Barium-tagged CT colonography
+        result = dict(
+            body_part=label.body_part,
+            code=code,
+            exam=label.exam,
+            custom=label.custom,
+            approximate=match_type == 'approximate',
+            score=label.score,
+        )
+    else:
+        code = None
+        match_type = None
+        result = None
+    return dict(
+        request=dict(
+            modality=modality,
+            exam=requested_exam or normalised_exam,
+        ),
+        result=result,
+    ), [
+        user_code,
+        version,
+        modality,
+        referral,
+        requested_exam,
+        normalised_exam,
+        tokenised,
+        code,
+        match_type,
+    ]
+
 @app.post('/autotriage')
 async def post_autotriage():
     try:
@@ -75,57 +140,47 @@ async def post_autotriage():
         try:
             user_code = r["user"]
             version = r["version"]
-            referral = r["referral"]
+            referral = int(r["referral"])
         except KeyError as e:
             raise ApiError(f"Missing key: {e.args[0]}")
-        async with comrad_pool.connection() as conn:
-            async with conn.cursor(row_factory=dict_row) as cur:
-                await cur.execute(referral_data_query, [referral], prepare=True)
-                result = await cur.fetchone()
-        if result is None:
+        except (TypeError, ValueError):
+            raise ApiError(f"Invalid referral ID: {r['referral']}")
+        if (data := (await fetch_referrals([referral])).get(referral)) is None:
             raise ApiError(f"Invalid referral ID: {referral}")
-        modality = result['modality']
-        requested_exam = result['requested_exam']
-        normalised_exam = result['normalised_exam']
-        patient_age = result['patient_age']
-        egfr = result['egfr']
-        tokenised = tokenise_request(requested_exam) if requested_exam is not None else tokenise_request(normalised_exam)
-        async with local_pool.connection() as conn:
-            async with await conn.execute(autotriage_query, [user_code, tokenised, modality], prepare=True) as cur:
-                result = await cur.fetchone()
-            if result is None and requested_exam is not None:
-                async with await conn.execute(autotriage_query, [user_code, tokenise_request(normalised_exam), modality], prepare=True) as cur:
-                    result = await cur.fetchone()
-            if result is not None:
-                code, exam, body_part, custom = result
-                if code in ('Q25', 'Q25C') and (patient_age >= 80 or egfr is not None and egfr < 30):
-                    code = 'Q25TC' if code == 'Q25C' else 'Q25T' # Barium-tagged CT colonography
-                result = dict(
-                    body_part=body_part,
-                    code=code,
-                    exam=exam,
-                    custom=custom,
-                )
-            else:
-                code = None
-            async with conn.cursor() as cur:
-                await cur.execute(autotriage_log_query, [
-                    user_code,
-                    version,
-                    modality,
-                    referral,
-                    requested_exam,
-                    normalised_exam,
-                    tokenised,
-                    code,
-                ], prepare=True)
-        return dict(
-            request=dict(
-                modality=modality,
-                exam=requested_exam or normalised_exam,
-            ),
-            result=result,
-        )
+        response, log = autotriage(user_code, version, referral, *data)
+        triage_log.write(log)
+        return response
+    except ApiError as e:
+        return dict(error=e.message), 400
+
+@app.post('/autotriage/batch')
+async def post_autotriage_batch():
+    """Autotriage a whole queue: {user, version, referrals: [...]} -> {results: [{referral, request, result} | {referral, error}]}"""
+    try:
+        try:
+            r = await request.get_json(force=True)
+        except BadRequest:
+            raise ApiError("Malformed JSON")
+        try:
+            user_code = r["user"]
+            version = r["version"]
+            referrals = r["referrals"]
+        except KeyError as e:
+            raise ApiError(f"Missing key: {e.args[0]}")
+        if not isinstance(referrals, list) or not all(isinstance(referral, int) for referral in referrals):
+            raise ApiError("Referrals must be a list of referral IDs")
+        if len(referrals) > MAX_BATCH:
+            raise ApiError(f"Maximum {MAX_BATCH} referrals")
+        referral_data = await fetch_referrals(referrals) if referrals else {}
+        results = []
+        for referral in referrals:
+            if (data := referral_data.get(referral)) is None:
+                results.append(dict(referral=referral, error=f"Invalid referral ID: {referral}"))
+                continue
+            response, log = autotriage(user_code, version, referral, *data)
+            results.append(dict(referral=referral, **response))
+            triage_log.write(log)
+        return dict(results=results)
     except ApiError as e:
         return dict(error=e.message), 400
 
@@ -143,8 +198,11 @@ async def autotriage_remember():
             code = r["code"]
         except KeyError as e:
             raise ApiError(f"Missing key: {e.args[0]}")
+        tokenised = tokenise_request(exam)
         async with local_pool.connection() as conn:
-            await conn.execute(remember_autotriage_query, [user, modality, tokenise_request(exam), code], prepare=True)
+            await conn.execute(remember_autotriage_query, [user, modality, tokenised, code], prepare=True)
+            await conn.commit()
+            await labels.remember(conn, user, modality, tokenised, code)
             return '', 204
     except ApiError as e:
         return dict(error=e.message), 400
@@ -1,10 +1,21 @@
+import time
+from os import environ
 from typing import LiteralString
+from quart import request, websocket
 from psycopg.rows import dict_row
 from . import app
 from ..database import comrad_pool
+from ..coalesce import coalesce
+from ..snapshot import Snapshot
 
-dashboard_query: LiteralString = r"""
-select
+MODALITIES = ["CT", "DI", "DS", "DX", "MC", "MM", "MR", "NM", "NO", "OD", "OT", "PT", "SC", "US", "XR"]
+
+# Rows can be committed a little after their timestamps, so hand clients a watermark with some overlap
+WATERMARK_MARGIN = 60
+
+STREAM_INTERVAL = float(environ.get('DASHBOARD_REFRESH_SECONDS', 10))
+
+dashboard_columns: LiteralString = r"""
     rf_registered_id id,
     rf_site::text site,
     rf_pat_type::text patient_type,
@@ -56,18 +67,36 @@ left join lateral (
     and trim(s) <> ''
     group by rf_registered_id
 ) as rad_notes on true
+"""
+
+dashboard_filter: LiteralString = r"""
 where (rf_new_rf_serial=0 or rf_new_rf_serial is null)
 and rf_status='W'
 and (rf_site in ('CDHB','EMER') or (rf_exam_type='NM' and rf_site='NUC'))
 and rf_pat_type in ('INP','ED')
+"""
+
+dashboard_query: LiteralString = "select" + dashboard_columns + dashboard_filter + r"""
 and rf_exam_type=%s
 order by rf_dor desc
 """
 
+dashboard_all_query: LiteralString = "select rf_exam_type::text modality," + dashboard_columns + dashboard_filter + r"""
+and rf_exam_type = any(%(modalities)s)
+-- Only receipt and triage are timestamped; edits to urgency, location and notes need a full fetch
+and (%(since)s::bigint is null or greatest(rf_dor, rf_triage_complete) > to_timestamp(%(since)s::bigint) at time zone 'Pacific/Auckland')
+order by rf_dor desc
+"""
+
+dashboard_ids_query: LiteralString = r"""
+select rf_exam_type::text, array_agg(rf_registered_id order by rf_dor desc)
+from case_referral""" + dashboard_filter + r"""
+and rf_exam_type = any(%s)
+group by rf_exam_type
+"""
 
-@app.get('/dashboard/<modality>')
-# ["CT", "DI", "DS", "DX", "MC", "MM", "MR", "NM", "NO", "OD", "OT", "PT", "SC", "US", "XR"]
-async def get_dashboard(modality: str):
+
+async def fetch_dashboard(modality: str) -> list[dict]:
     async with comrad_pool.connection() as conn:
         async with conn.cursor(row_factory=dict_row) as cur:
             await cur.execute("set local enable_sort = off")
@@ -75,3 +104,90 @@ async def get_dashboard(modality: str):
             await cur.execute(dashboard_query, [modality], prepare=True)
             return await cur.fetchall()
 
+
+@app.get('/dashboard/<modality>')
+@coalesce
+async def get_dashboard(modality: str):
+    return await fetch_dashboard(modality)
+
+
+def diff_dashboard(old: list[dict], new: list[dict]) -> dict | None:
+    old_rows = {row['id']: row for row in old}
+    new_rows = {row['id']: row for row in new}
+    added = [row for id, row in new_rows.items() if id not in old_rows]
+    changed = [row for id, row in new_rows.items() if id in old_rows and old_rows[id] != row]
+    removed = [id for id in old_rows if id not in new_rows]
+    if added or changed or removed:
+        return dict(added=added, changed=changed, removed=removed)
+
+
+# One poller per modality, running only while someone is subscribed
+dashboard_snapshots: dict[str, Snapshot] = {}
+
+
+@app.websocket('/dashboard/<modality>/stream')
+async def dashboard_stream(modality: str):
+    # First message is {type: 'snapshot', data}, then {type: 'delta', added, changed, removed}
+    # where added/changed are full rows and removed are referral IDs.
+    if modality not in MODALITIES:
+        await websocket.close(1008, f'Unknown modality: {modality}')
+        return
+    if (snapshot := dashboard_snapshots.get(modality)) is None:
+        snapshot = dashboard_snapshots[modality] = Snapshot(
+            f'{modality} dashboard',
+            lambda: fetch_dashboard(modality),
+            STREAM_INTERVAL,
+            diff_dashboard,
+        )
+    try:
+        async with snapshot.subscribe() as updates:
+            snapshot.start()
+            async for message in updates:
+                await websocket.send(message)
+    finally:
+        if snapshot.subscribers == 0:
+            # Unregister before awaiting, so a client connecting meanwhile gets a fresh poller
+            if dashboard_snapshots.get(modality) is snapshot:
+                del dashboard_snapshots[modality]
+            await snapshot.stop()
+
+
+@app.get('/dashboard')
+@coalesce
+async def get_dashboard_all():
+    """
+    Waiting lists for several modalities (?modality=CT&modality=MR, default all) from one query.
+
+    With ?since=<epoch>, only referrals received or triaged after that time are returned,
+    together with the IDs of every referral still waiting so clients can drop the rest.
+    ComRad has no change time for urgency, location or notes, so later edits to referrals
+    a client already has are not picked up by `since`: clients should also fetch in full
+    (without `since`) every few minutes.
+    """
+    modalities = request.args.getlist('modality') or MODALITIES
+    since = request.args.get('since', None, type=int)
+    watermark = int(time.time()) - WATERMARK_MARGIN
+    async with comrad_pool.connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute("set local enable_sort = off")
+            await cur.execute("set local jit_above_cost = -1")
+            await cur.execute(dashboard_all_query, dict(modalities=modalities, since=since), prepare=True)
+            referrals = {modality: [] for modality in modalities}
+            async for row in cur:
+                referrals[row.pop('modality')].append(row)
+        if since is not None:
+            async with await conn.execute(dashboard_ids_query, [modalities], prepare=True) as cur:
+                waiting = {modality: [] for modality in modalities} | {modality: ids async for modality, ids in cur}
+    result = dict(
+        watermark=watermark,
+        modalities=referrals,
+    )
+    if since is not None:
+        result['ids'] = waiting # pyright: ignore[reportPossiblyUnboundVariable]
+    return result
+
+
+@app.after_serving
+async def stop_dashboard_streams():
+    for snapshot in list(dashboard_snapshots.values()):
+        await snapshot.stop()
@@ -5,6 +5,7 @@ from psycopg.rows import dict_row
 from psycopg.types.json import Jsonb
 from . import app
 from ..database import local_pool
+from ..coalesce import coalesce
 
 
 update_users: LiteralString = r"""
@@ -38,6 +39,7 @@ async def post_desks():
             return ('',204)
 
 @app.get('/desks')
+@coalesce
 async def get_desks():
     async with local_pool.connection() as conn:
         async with conn.cursor(row_factory=dict_row) as cur:
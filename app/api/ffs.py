@@ -1,48 +1,37 @@
+import asyncio
+import logging
+from contextlib import suppress
+from os import environ
 from typing import LiteralString
-from datetime import date, timedelta
+from datetime import date, datetime, time, timedelta
 from quart import request
 from werkzeug.exceptions import BadRequest
 from psycopg.rows import dict_row
 
-from . import app, HOLIDAYS
+from . import app, TZ, HOLIDAYS
 from ..database import comrad_pool, local_pool
 from .error import ApiError
+from ..registrar_numbers.parts_parser import calculate, clean, split
 
-ffs_users: LiteralString = r"""
-with staff_list as (
-    select distinct ct_staff_serial
-    from case_staff
-    join case_event on ct_ce_serial = ce_serial and ct_staff_function = 'R'
-    join reports on ct_key = re_serial and ct_key_type = 'R' and (re_old_version is null or re_old_version = 0)
-    join orders on or_event_serial = ce_serial and or_status != 'X'
-    join sel_table as site ON ce_site = site.sl_key AND site.sl_code = 'SIT'
-    where ct_dor >= %s and ct_dor < %s + 1
-    and or_ex_type IN ('CT', 'MR', 'US', 'XR', 'OD')
-    and site.sl_aux1 = 'CDHB'
-    and ce_site NOT IN ('HAN', 'KAIK', 'CARD')
-    and (
-        extract(hour from ct_dor) not between 8 and 17
-        or extract(isodow from ct_dor) > 5
-        or date(ct_dor) = any(%s)
-    )
-)
-select st_user_code::text, st_surname::text, st_firstnames::text
-from staff_list
-join staff on st_serial = ct_staff_serial
-where st_job_class = 'MC'
-and st_user_code !~ 'Z[A-Z]+RAD'
-and st_user_code <> 'ELR'
-order by st_surname
-"""
+MAX_DAYS = 366 # per request
+MAX_LIVE_DAYS = 28 # not yet materialised, so queried straight from ComRad
+FFS_BACKFILL_DAYS = int(environ.get('FFS_BACKFILL_DAYS', 400))
+FFS_REFRESH_DAYS = int(environ.get('FFS_REFRESH_DAYS', 7)) # rematerialised nightly to pick up late changes
+FFS_MATERIALISE_HOUR = int(environ.get('FFS_MATERIALISE_HOUR', 2))
+# Missing days are backfilled a few at a time, pausing between batches, so ComRad and the workers aren't tied up
+FFS_BACKFILL_BATCH_DAYS = int(environ.get('FFS_BACKFILL_BATCH_DAYS', 7))
+FFS_BACKFILL_PAUSE_SECONDS = float(environ.get('FFS_BACKFILL_PAUSE_SECONDS', 300))
+BODY_PARTS_REFRESH_SECONDS = float(environ.get('FFS_BODY_PARTS_REFRESH_SECONDS', 300))
+# Startup doesn't wait long for the local database; until the first load succeeds it is retried more often
+BODY_PARTS_STARTUP_TIMEOUT = float(environ.get('FFS_BODY_PARTS_STARTUP_TIMEOUT', 5))
+BODY_PARTS_RETRY_SECONDS = float(environ.get('FFS_BODY_PARTS_RETRY_SECONDS', 30))
 
-ffs_query: LiteralString = r"""
-with reports as (
-    select
+ffs_columns: LiteralString = r"""
     case_staff_V.ct_dor as nz_time,
     extract(hour from case_staff_V.ct_dor) not between 8 and 17 as nz_after_hours,
     extract(isodow from case_staff_V.ct_dor) > 5 as nz_weekend,
-    date(case_staff_V.ct_dor) = any(%s) as nz_holiday,
-    case_staff_V.ct_dor at time zone 'Pacific/Auckland' at time zone %s as local_time,
+    date(case_staff_V.ct_dor) = any(%(holidays)s) as nz_holiday,
+    case_staff_V.ct_dor at time zone 'Pacific/Auckland' at time zone %(timezone)s as local_time,
     or_accession_no::text,
     case when or_ex_type = 'OD' then 'XR' else or_ex_type end as examType,
     ce_description,
@@ -58,11 +47,13 @@ with reports as (
     join reports on case_staff_V.ct_key = re_serial and case_staff_V.ct_key_type = 'R' and case_staff_R.ct_key = re_serial and case_staff_R.ct_key_type = 'R' and (re_old_version is null or re_old_version = 0)
     join orders on or_event_serial = ce_serial and or_status != 'X'
     join sel_table as site ON ce_site = site.sl_key AND site.sl_code = 'SIT'
-    where staff_V.st_user_code = %s
-    and case_staff_V.ct_dor >= %s and case_staff_V.ct_dor < %s + 1
+    where case_staff_V.ct_dor >= %(from)s and case_staff_V.ct_dor < %(to)s + 1
     and or_ex_type IN ('CT', 'MR', 'US', 'XR', 'OD')
     and site.sl_aux1 = 'CDHB'
     and ce_site NOT IN ('HAN', 'KAIK', 'CARD')
+"""
+
+ffs_criteria: LiteralString = r"""
 ),
 critieria as (
     select *,
@@ -73,11 +64,343 @@ critieria as (
 select *,
 nz_eligible and local_eligible as eligible
 from critieria
-where coalesce(%s = (nz_eligible and local_eligible), true)
+where coalesce(%(eligible)s = (nz_eligible and local_eligible), true)
+"""
+
+ffs_query: LiteralString = r"""
+with reports as (
+    select""" + ffs_columns + r"""
+    and staff_V.st_user_code = %(user)s""" + ffs_criteria
+
+# Eligible radiologists
+ffs_radiologist: LiteralString = r"""staff_V.st_job_class = 'MC'
+    and staff_V.st_user_code !~ 'Z[A-Z]+RAD'
+    and staff_V.st_user_code <> 'ELR'"""
+
+ffs_user_columns: LiteralString = r"""
+    staff_V.st_user_code::text as user_code,
+    staff_V.st_firstnames::text as user_firstnames,
+    staff_V.st_surname::text as user_surname,"""
+
+# Radiologists with out-of-hours reports, over exactly the reports ffs_facts would hold
+ffs_users: LiteralString = r"""
+select distinct user_code, user_firstnames, user_surname
+from (
+    select""" + ffs_user_columns + ffs_columns + r"""
+    and """ + ffs_radiologist + r"""
+) reports
+where nz_after_hours or nz_weekend or nz_holiday
+"""
+
+# Every eligible radiologist at once
+ffs_bulk_query: LiteralString = r"""
+with reports as (
+    select""" + ffs_user_columns + ffs_columns + r"""
+    and """ + ffs_radiologist + ffs_criteria + r"""
+order by user_surname, user_code, nz_time
+"""
+
+# Per-report facts for one day, for every reporter, to materialise into the local ffs_facts table
+ffs_facts_query: LiteralString = r"""
+select
+    date(case_staff_V.ct_dor) as day,""" + ffs_user_columns + r"""
+    """ + ffs_radiologist + r""" as radiologist,""" + ffs_columns
+
+FFS_FACT_COLUMNS = (
+    'day',
+    'user_code',
+    'user_firstnames',
+    'user_surname',
+    'radiologist',
+    'nz_time',
+    'nz_after_hours',
+    'nz_weekend',
+    'nz_holiday',
+    'or_accession_no',
+    'examtype',
+    'ce_description',
+    'imaged',
+    'ce_site',
+    'verifier',
+    'prelim_reporter',
+)
+
+ffs_facts_copy: LiteralString = "copy ffs_facts (" + ", ".join(FFS_FACT_COLUMNS) + ") from stdin"
+
+ffs_facts_days_upsert: LiteralString = r"""
+insert into ffs_facts_days (day, reports) values (%s, %s)
+on conflict (day) do update
+set reports = excluded.reports, refreshed = now()
+"""
+
+# Local equivalent of ffs_query/ffs_bulk_query over materialised days
+ffs_facts_read_query: LiteralString = r"""
+with reports as (
+    select
+    user_code,
+    user_firstnames,
+    user_surname,
+    nz_time,
+    nz_after_hours,
+    nz_weekend,
+    nz_holiday,
+    nz_time at time zone 'Pacific/Auckland' at time zone %(timezone)s as local_time,
+    or_accession_no,
+    examtype,
+    ce_description,
+    imaged,
+    ce_site,
+    verifier,
+    prelim_reporter
+    from ffs_facts
+    where day = any(%(days)s)
+    and (user_code = %(user)s or %(user)s::text is null and radiologist)""" + ffs_criteria
+
+ffs_facts_users_query: LiteralString = r"""
+select distinct user_code, user_firstnames, user_surname
+from ffs_facts
+where day = any(%s)
+and radiologist
+and (nz_after_hours or nz_weekend or nz_holiday)
+"""
+
+body_parts_query: LiteralString = r"""
+select name, parts, machine_derived from ffs_body_parts
+"""
+
+# Never overwrites a row, so manual classifications always win
+body_parts_insert: LiteralString = r"""
+insert into ffs_body_parts (name, parts, machine_derived)
+values (%(name)s, %(parts)s, true)
+on conflict do nothing
 """
 
+
+class BodyParts:
+    """
+    In-memory copy of `ffs_body_parts`, lower-cased CT/XR description to body parts.
+
+    XR descriptions missing from the table are classified with the registrar numbers
+    parts parser and, when it recognises at least one part, written back flagged
+    `machine_derived` so they can be reviewed. CT descriptions and anything the
+    parser doesn't recognise stay unknown. The map is reloaded every
+    BODY_PARTS_REFRESH_SECONDS to pick up corrections. If the local database is
+    down at startup, loading is retried in the background and on first use.
+    """
+
+    def __init__(self):
+        self._parts: dict[str, int] = {}
+        self._machine_derived: set[str] = set()
+        self._unparsed: set[str] = set() # not retried until the next reload
+        self._loaded = False
+        self._task: asyncio.Task | None = None
+
+    async def load(self, timeout: float | None = None):
+        parts, machine_derived = {}, set()
+        async with local_pool.connection(timeout) as conn:
+            async with await conn.execute(body_parts_query) as cur:
+                async for name, count, derived in cur:
+                    parts[name] = count
+                    if derived:
+                        machine_derived.add(name)
+        self._parts, self._machine_derived, self._unparsed = parts, machine_derived, set()
+        self._loaded = True
+        logging.info(f'Loaded {len(self._parts)} FFS body parts ({len(self._machine_derived)} machine derived)')
+
+    async def lookup(self, descriptions: set[tuple[str, str]]) -> tuple[dict[str, int], set[str]]:
+        """Body parts and machine derived names for (examtype, description) pairs, classifying new XR descriptions."""
+        if not self._loaded:
+            await self.load() # otherwise every description would look new
+        classified = {}
+        for examtype, description in descriptions:
+            name = description.lower()
+            if examtype != 'XR' or name in self._parts or name in self._unparsed:
+                continue
+            # Unlike parse_cleaned, no floor of 1: an unrecognised description is unknown, not one part
+            if (count := calculate(split(clean(description.upper())))) > 0:
+                classified[name] = count
+            else:
+                self._unparsed.add(name)
+        if classified:
+            async with local_pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.executemany(body_parts_insert, [dict(name=name, parts=parts) for name, parts in classified.items()])
+            self._parts.update(classified)
+            self._machine_derived.update(classified)
+            logging.info(f'Classified {len(classified)} new FFS descriptions')
+        return self._parts, self._machine_derived
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(BODY_PARTS_REFRESH_SECONDS if self._loaded else BODY_PARTS_RETRY_SECONDS)
+            try:
+                await self.load()
+            except Exception:
+                logging.exception('Error reloading FFS body parts')
+
+    async def open(self):
+        try:
+            await self.load(BODY_PARTS_STARTUP_TIMEOUT)
+        except Exception:
+            logging.exception('FFS body parts unavailable at startup, retrying in the background')
+        self._task = asyncio.create_task(self._run(), name='FFS body parts')
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+body_parts = BodyParts()
+
+def calculate_ffs(results: list[dict], body_parts: dict[str, int], machine_derived: set[str]) -> dict:
+    total_fee = 0
+    unknowns = dict(XR=set(), CT=set())
+    derived = dict(XR=set(), CT=set())
+    tally = dict(
+        CT=[0, 0, 0, 0],
+        XR=[0, 0, 0],
+        MR=[0],
+        US=[0],
+    )
+    for result in results:
+        if not (result['local_eligible'] and (result['nz_weekend'] or result['nz_holiday'] or result['nz_after_hours'])):
+            continue
+        if result['examtype'] in ('CT','XR'):
+            if not (bps := body_parts.get(result['ce_description'].lower())):
+                unknowns[result['examtype']].add(result['ce_description'])
+                continue
+            if result['ce_description'].lower() in machine_derived:
+                derived[result['examtype']].add(result['ce_description'])
+        else:
+            bps = 1
+        tally[result['examtype']][min(bps, len(tally[result['examtype']])) - 1] += 1
+        match result['examtype']:
+            case 'XR': fee = 35 if bps >= 3 else 20 if bps >= 2 else 12 if bps >= 1 else 0
+            case 'CT': fee = 200 if bps >= 4 else 160 if bps >= 3 else 135 if bps >= 2 else 60 if bps >= 1 else 0
+            case 'MR': fee = 75 if bps >= 1 else 0
+            case 'US': fee = 12 if bps >= 1 else 0
+            case _: continue
+        total_fee += fee
+        result['ffs'] = dict(
+            body_parts=bps,
+            fee=fee,
+            machine_derived=result['examtype'] in ('CT','XR') and result['ce_description'].lower() in machine_derived,
+        )
+    return dict(
+        results=results,
+        count=len(results),
+        tally=tally,
+        fee=total_fee,
+        unknowns=dict(XR=list(unknowns['XR']), CT=list(unknowns['CT'])),
+        machine_derived=dict(XR=list(derived['XR']), CT=list(derived['CT'])),
+    )
+
+async def fetch_body_parts(results: list[dict]) -> tuple[dict[str, int], set[str]]:
+    return await body_parts.lookup({(result["examtype"], result["ce_description"]) for result in results if result["examtype"] in ('CT','XR') and result["ce_description"]})
+
+def holidays_between(from_date: date, to_date: date) -> list[date]:
+    return [d for d in (from_date + timedelta(days=x) for x in range((to_date - from_date).days + 1)) if d in HOLIDAYS]
+
+async def materialise_ffs_day(day: date):
+    """(Re)write the FFS facts for one closed day; safe to repeat."""
+    async with comrad_pool.connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(ffs_facts_query, {
+                "holidays": holidays_between(day, day),
+                "timezone": "Pacific/Auckland",
+                "from": day,
+                "to": day,
+            }, prepare=True)
+            rows = await cur.fetchall()
+    async with local_pool.connection() as conn:
+        async with conn.transaction():
+            await conn.execute("delete from ffs_facts where day = %s", [day])
+            async with conn.cursor() as cur:
+                async with cur.copy(ffs_facts_copy) as copy:
+                    for row in rows:
+                        await copy.write_row([row[column] for column in FFS_FACT_COLUMNS])
+            await conn.execute(ffs_facts_days_upsert, [day, len(rows)])
+
+async def materialise_ffs(refresh: bool) -> int:
+    """
+    Materialise the most recent FFS_BACKFILL_BATCH_DAYS missing days within the backfill window,
+    and with `refresh` the last FFS_REFRESH_DAYS days as well. Returns the days still missing.
+    """
+    today = datetime.now(tz=TZ).date()
+    days = [today - timedelta(days=n) for n in range(1, FFS_BACKFILL_DAYS + 1)]
+    async with local_pool.connection() as conn:
+        async with await conn.execute("select day from ffs_facts_days where day >= %s", [days[-1]]) as cur:
+            done = {day async for day, in cur}
+    missing = [day for day in days if day not in done]
+    todo = missing[:FFS_BACKFILL_BATCH_DAYS]
+    if refresh:
+        todo = sorted(set(todo) | set(days[:FFS_REFRESH_DAYS]), reverse=True)
+    for day in todo:
+        await materialise_ffs_day(day)
+    remaining = len(missing) - len(set(missing) & set(todo))
+    logging.info(f'Materialised FFS facts for {len(todo)} days, {remaining} days left to backfill')
+    return remaining
+
+async def run_ffs_materialiser():
+    refresh = False # recent days are refreshed nightly; at startup only missing days are filled in
+    while True:
+        try:
+            remaining = await materialise_ffs(refresh)
+            refresh = False
+        except Exception:
+            # Retried (with the same refresh) after the pause, rather than waiting for the next nightly run
+            logging.exception('Error materialising FFS facts')
+            await asyncio.sleep(FFS_BACKFILL_PAUSE_SECONDS)
+            continue
+        if remaining:
+            await asyncio.sleep(FFS_BACKFILL_PAUSE_SECONDS)
+            continue
+        now = datetime.now(tz=TZ)
+        next_run = datetime.combine(now.date(), time(FFS_MATERIALISE_HOUR), tzinfo=TZ)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+        refresh = True
+
+ffs_materialiser: asyncio.Task | None = None
+
+@app.before_serving
+async def start_ffs_materialiser():
+    global ffs_materialiser
+    ffs_materialiser = asyncio.create_task(run_ffs_materialiser(), name='FFS materialiser')
+
+@app.before_serving
+async def open_body_parts():
+    await body_parts.open()
+
+@app.after_serving
+async def close_body_parts():
+    await body_parts.close()
+
+@app.after_serving
+async def stop_ffs_materialiser():
+    global ffs_materialiser
+    if (task := ffs_materialiser) is not None:
+        ffs_materialiser = None
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task # let an in-flight COPY roll back; the pools close after this (see app.close_db_pool)
+
+async def materialised_days(from_date: date, to_date: date) -> set[date]:
+    async with local_pool.connection() as conn:
+        async with await conn.execute("select day from ffs_facts_days where day between %s and %s", [from_date, to_date]) as cur:
+            return {day async for day, in cur}
+
 @app.post('/ffs')
 async def post_ffs():
+    """
+    Fee-for-service for one radiologist ({from, to, timezone, user, eligible}), or for every
+    eligible radiologist in one pass when "bulk" is true. Without a user, lists the radiologists.
+
+    Closed days are read from the materialised ffs_facts table; only days not yet
+    materialised (always including today) are queried from ComRad.
+    """
     try:
         try:
             r = await request.get_json(force=True)
@@ -85,9 +408,9 @@ async def post_ffs():
             raise ApiError("Malformed JSON")
         try:
             from_date, to_date = date.fromisoformat(r["from"]), date.fromisoformat(r["to"])
-            if (delta := (to_date - from_date).days) >= 28:
-                raise ApiError("Maximum 28 days")
-            holidays = [d for d in (from_date + timedelta(days=x) for x in range(delta + 1)) if d in HOLIDAYS]
+            if (delta := (to_date - from_date).days) >= MAX_DAYS:
+                raise ApiError(f"Maximum {MAX_DAYS} days")
+            days = [from_date + timedelta(days=x) for x in range(delta + 1)]
         except ApiError:
             raise
         except KeyError as e:
@@ -96,71 +419,89 @@ async def post_ffs():
             raise ApiError(str(e))
         except:
             raise ApiError("Invalid request")
-        async with comrad_pool.connection() as conn:
-            async with conn.cursor(row_factory=dict_row) as cur:
-                try:
-                    await cur.execute(ffs_query, [
-                        holidays,
-                        r["timezone"],
-                        r["user"],
-                        from_date,
-                        to_date,
-                        r["eligible"],
-                    ],prepare=True)
-                    results = await cur.fetchall()
-                except KeyError:
-                    await cur.execute(ffs_users, [
-                        from_date,
-                        to_date,
-                        holidays,
-                    ],prepare=True)
-                    return {u["st_user_code"]: (u["st_firstnames"], u["st_surname"]) async for u in cur}
-        async with local_pool.connection() as conn:
-            async with await conn.execute(
-                "select name, parts from ffs_body_parts where name=any(%s)",
-                [list(set([result["ce_description"].lower() for result in results if result["examtype"] in ('CT','XR')]))],
-                prepare=True,
-                ) as cur:
-                body_parts = {description: parts async for description, parts in cur}
-        total_fee = 0
-        unknowns = dict(XR=set(), CT=set())
-        tally = dict(
-            CT=[0, 0, 0, 0],
-            XR=[0, 0, 0],
-            MR=[0],
-            US=[0],
-        )
+        bulk = bool(r.get("bulk"))
+        try:
+            timezone, eligible = r["timezone"], r["eligible"]
+            user = None if bulk else r["user"]
+            listing = False
+        except KeyError:
+            if bulk:
+                raise ApiError("Missing key: timezone or eligible")
+            listing = True
+        materialised = await materialised_days(from_date, to_date) if days else set()
+        stored_days = [day for day in days if day in materialised]
+        live_days = [day for day in days if day not in materialised]
+        if live_days and (live_days[-1] - live_days[0]).days >= MAX_LIVE_DAYS:
+            raise ApiError(f"Maximum {MAX_LIVE_DAYS} days not yet in the FFS database ({live_days[0]} to {live_days[-1]})")
+        if listing:
+            users: dict[str, tuple[str, str]] = {}
+            if stored_days:
+                async with local_pool.connection() as conn:
+                    async with await conn.execute(ffs_facts_users_query, [stored_days]) as cur:
+                        users.update({user_code: (first, last) async for user_code, first, last in cur})
+            if live_days:
+                async with comrad_pool.connection() as conn:
+                    async with await conn.execute(ffs_users, {
+                        "holidays": holidays_between(live_days[0], live_days[-1]),
+                        "timezone": "Pacific/Auckland",
+                        "from": live_days[0],
+                        "to": live_days[-1],
+                    }, prepare=True) as cur:
+                        users.update({user_code: (first, last) async for user_code, first, last in cur})
+            return dict(sorted(users.items(), key=lambda user: user[1][1]))
+        results = []
+        if stored_days:
+            async with local_pool.connection() as conn:
+                async with conn.cursor(row_factory=dict_row) as cur:
+                    await cur.execute(ffs_facts_read_query, dict(
+                        days=stored_days,
+                        timezone=timezone, # pyright: ignore[reportPossiblyUnboundVariable]
+                        user=user, # pyright: ignore[reportPossiblyUnboundVariable]
+                        eligible=eligible, # pyright: ignore[reportPossiblyUnboundVariable]
+                    ), prepare=True)
+                    results.extend(await cur.fetchall())
+            if not bulk:
+                for result in results:
+                    del result['user_code'], result['user_firstnames'], result['user_surname']
+        if live_days:
+            params = {
+                "holidays": holidays_between(live_days[0], live_days[-1]),
+                "timezone": timezone, # pyright: ignore[reportPossiblyUnboundVariable]
+                "from": live_days[0],
+                "to": live_days[-1],
+                "eligible": eligible, # pyright: ignore[reportPossiblyUnboundVariable]
+            }
+            if not bulk:
+                params["user"] = user # pyright: ignore[reportPossiblyUnboundVariable]
+            async with comrad_pool.connection() as conn:
+                async with conn.cursor(row_factory=dict_row) as cur:
+                    await cur.execute(ffs_bulk_query if bulk else ffs_query, params, prepare=True)
+                    results.extend(result for result in await cur.fetchall() if result['nz_time'].date() not in materialised)
+        if bulk:
+            results.sort(key=lambda result: (result['user_surname'], result['user_code'], result['nz_time']))
+        else:
+            results.sort(key=lambda result: result['nz_time'])
+        body_parts, machine_derived = await fetch_body_parts(results)
+        if not bulk:
+            return calculate_ffs(results, body_parts, machine_derived)
+        users = {}
         for result in results:
-            if not (result['local_eligible'] and (result['nz_weekend'] or result['nz_holiday'] or result['nz_after_hours'])):
-                continue
-            if result['examtype'] in ('CT','XR'):
-                try:
-                    bps = body_parts[result['ce_description'].lower()]
-                except KeyError:
-                    unknowns[result['examtype']].add(result['ce_description'])
-                    continue
+            user_code = result.pop('user_code')
+            if user_code not in users:
+                users[user_code] = dict(
+                    first=result.pop('user_firstnames'),
+                    last=result.pop('user_surname'),
+                    results=[],
+                )
             else:
-                bps = 1
-            if bps is None:
-                pass
-            tally[result['examtype']][bps-1] += 1
-            match result['examtype']:
-                case 'XR': fee = 35 if bps >= 3 else 20 if bps >= 2 else 12 if bps >= 1 else 0
-                case 'CT': fee = 200 if bps >= 4 else 160 if bps >= 3 else 135 if bps >= 2 else 60 if bps >= 1 else 0
-                case 'MR': fee = 75 if bps >= 1 else 0
-                case 'US': fee = 12 if bps >= 1 else 0
-                case _: continue
-            total_fee += fee
-            result['ffs'] = dict(
-                body_parts=bps,
-                fee=fee,
-            )
+                del result['user_firstnames'], result['user_surname']
+            users[user_code]['results'].append(result)
+        for user in users.values():
+            user.update(calculate_ffs(user.pop('results'), body_parts, machine_derived))
         return dict(
-            results=results,
+            users=users,
             count=len(results),
-            tally=tally,
-            fee=total_fee,
-            unknowns=dict(XR=list(unknowns['XR']), CT=list(unknowns['CT'])),
+            fee=sum(user['fee'] for user in users.values()),
         )
     except ApiError as e:
         return dict(error=e.message), 400
@@ -0,0 +1,125 @@
+import logging
+from os import environ
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, LiteralString
+from psycopg import AsyncConnection
+
+labels_query: LiteralString = r"""
+select modality, tokenised, username, code
+from label
+"""
+
+examinations_query: LiteralString = r"""
+select modality, code, name, body_part
+from examination
+where (%(modality)s::text is null or modality = %(modality)s)
+and (%(code)s::text is null or code = %(code)s)
+"""
+
+
+# Minimum share of a label's tokens that a request must contain for an approximate match.
+# Labels are mostly one or two tokens, so this is measured against the label rather than the
+# union of both (Jaccard), which would reject "head trauma" for the label "head".
+MATCH_THRESHOLD = float(environ.get('AUTOTRIAGE_MATCH_THRESHOLD', 0.6))
+
+
+@dataclass(frozen=True, slots=True)
+class Match:
+    code: str
+    exam: str
+    body_part: Any
+    custom: bool
+    score: float = 1
+
+
+class LabelIndex:
+    """
+    In-memory copy of the autotriage `label` table joined to `examination`.
+
+    Labels are keyed by (modality, tokenised), each holding the global label
+    (username null) and any per-user overrides. Lookups follow the precedence
+    of the original query: the user's own label, then the global label, then
+    any other user's label.
+
+    An inverted index from each token to the tokenised strings containing it
+    backs `approximate`, the fallback for requests with no exact label.
+    """
+
+    def __init__(self):
+        self._labels: dict[tuple[str, str], dict[str | None, str]] = {}
+        self._examinations: dict[tuple[str, str], tuple[str, Any]] = {}
+        self._tokens: dict[str, dict[str, set[str]]] = {}
+
+    async def load(self, conn: AsyncConnection):
+        async with await conn.execute(examinations_query, dict(modality=None, code=None)) as cur:
+            self._examinations = {(modality, code): (name, body_part) async for modality, code, name, body_part in cur}
+        labels: dict[tuple[str, str], dict[str | None, str]] = {}
+        async with await conn.execute(labels_query) as cur:
+            async for modality, tokenised, username, code in cur:
+                labels.setdefault((modality, tokenised), {})[username] = code
+        self._labels = labels
+        self._tokens = {}
+        for modality, tokenised in labels:
+            self._index(modality, tokenised)
+        logging.info(f'Loaded {len(labels)} autotriage labels and {len(self._examinations)} examinations')
+
+    def lookup(self, user: str | None, tokenised: str, modality: str) -> Match | None:
+        if (labels := self._labels.get((modality, tokenised))) is None:
+            return None
+        candidates = [username for username, code in labels.items() if (modality, code) in self._examinations]
+        if not candidates:
+            return None
+        if user is not None and user in candidates:
+            username = user
+        elif None in candidates:
+            username = None
+        else:
+            username = min(candidates) # pyright: ignore[reportArgumentType]
+        code = labels[username]
+        exam, body_part = self._examinations[(modality, code)]
+        return Match(code, exam, body_part, user is not None and username == user)
+
+    def approximate(self, user: str | None, tokenised: str, modality: str) -> Match | None:
+        """
+        Label whose tokens are best covered by `tokenised`, if the coverage reaches MATCH_THRESHOLD.
+        Ties go to the label leaving the fewest request tokens unmatched.
+        """
+        tokens = set(tokenised.split())
+        if not tokens or (index := self._tokens.get(modality)) is None:
+            return None
+        shared = Counter(candidate for token in tokens for candidate in index.get(token, ()))
+        scored = sorted(
+            (
+                (count / len(candidate_tokens), len(tokens - candidate_tokens), candidate)
+                for candidate, count in shared.items()
+                if (candidate_tokens := set(candidate.split()))
+            ),
+            key=lambda scored: (-scored[0], scored[1], scored[2]),
+        )
+        for score, _, candidate in scored:
+            if score < MATCH_THRESHOLD:
+                break
+            if (match := self.lookup(user, candidate, modality)) is not None:
+                return Match(match.code, match.exam, match.body_part, match.custom, round(score, 3))
+        return None
+
+    def _index(self, modality: str, tokenised: str):
+        index = self._tokens.setdefault(modality, {})
+        for token in set(tokenised.split()):
+            index.setdefault(token, set()).add(tokenised)
+
+    async def remember(self, conn: AsyncConnection, user: str | None, modality: str, tokenised: str, code: str):
+        """Write-through after `label` has been upserted."""
+        if (modality, code) not in self._examinations:
+            async with await conn.execute(examinations_query, dict(modality=modality, code=code)) as cur:
+                async for exam_modality, exam_code, name, body_part in cur:
+                    self._examinations[(exam_modality, exam_code)] = (name, body_part)
+        self._labels.setdefault((modality, tokenised), {})[user] = code
+        self._index(modality, tokenised)
+
+    def __len__(self):
+        return len(self._labels)
+
+
+labels = LabelIndex()
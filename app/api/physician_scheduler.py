@@ -2,7 +2,7 @@ from typing import LiteralString
 from itertools import groupby
 from quart import request
 from . import app
-from ..database import phy_sch_connection
+from ..database import phy_sch_pool
 
 base_roster_query_users = r"""
 select distinct Employee.Abbr, FirstName, LastName
@@ -11,11 +11,9 @@ join Employee on Pattern.EmployeeID=Employee.EmployeeID
 order by LastName
 """
 @app.get('/base_roster/users') # pyright: ignore[reportArgumentType]
-def get_base_roster_users():
-    with phy_sch_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(base_roster_query_users)
-            return cursor.fetchall()
+async def get_base_roster_users():
+    async with phy_sch_pool.connection() as conn:
+        return await conn.fetchall(base_roster_query_users)
 
 base_roster_query_shifts = r"""
 select distinct ShiftName
@@ -24,11 +22,9 @@ join Shift on Shift.ShiftID = Pattern.ShiftID
 order by ShiftName
 """
 @app.get('/base_roster/shifts')
-def get_base_roster_shifts():
-    with phy_sch_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(base_roster_query_shifts)
-            return [shift for shift, in cursor] # pyright: ignore[reportGeneralTypeIssues]
+async def get_base_roster_shifts():
+    async with phy_sch_pool.connection() as conn:
+        return [shift for shift, in await conn.fetchall(base_roster_query_shifts)]
 
 base_roster_query_user = r"""
 select DayNum as day, ShiftName as shift
@@ -40,11 +36,10 @@ and IsRetired=0
 order by DayNum, StartTime
 """
 @app.get('/base_roster/user/<string:user_code>')
-def get_base_roster_user(user_code: str):
-    with phy_sch_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(base_roster_query_user, user_code)
-            return {str(day):[shift for _, shift in shifts] for day, shifts in groupby(cursor, lambda x: x[0])} # pyright: ignore[reportOptionalSubscript, reportGeneralTypeIssues]
+async def get_base_roster_user(user_code: str):
+    async with phy_sch_pool.connection() as conn:
+        rows = await conn.fetchall(base_roster_query_user, user_code)
+    return {str(day):[shift for _, shift in shifts] for day, shifts in groupby(rows, lambda x: x[0])}
 
 base_roster_query_shift = r"""
 select DayNum as day,
@@ -58,11 +53,10 @@ where ShiftName=%s
 order by DayNum, Employee.LastName
 """
 @app.get('/base_roster/shift/<string:shift_name>')
-def get_base_roster_shift(shift_name: str):
-    with phy_sch_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(base_roster_query_shift, shift_name)
-            return {str(day):[(user_code, first_name, last_name) for _, user_code, first_name, last_name in users] for day, users in groupby(cursor.fetchall(), lambda x: x[0])} # pyright: ignore[reportCallIssue, reportArgumentType]
+async def get_base_roster_shift(shift_name: str):
+    async with phy_sch_pool.connection() as conn:
+        rows = await conn.fetchall(base_roster_query_shift, shift_name)
+    return {str(day):[(user_code, first_name, last_name) for _, user_code, first_name, last_name in users] for day, users in groupby(rows, lambda x: x[0])}
 
 requests_query_users = r"""
 select
@@ -77,11 +71,9 @@ join Employee E on R.EmployeeID=E.EmployeeID
 order by LastName
 """
 @app.get('/requests/users') # pyright: ignore[reportArgumentType]
-def get_requests_users():
-    with phy_sch_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(requests_query_users)
-            return cursor.fetchall()
+async def get_requests_users():
+    async with phy_sch_pool.connection() as conn:
+        return await conn.fetchall(requests_query_users)
 
 requests_query_shifts = r"""
 select distinct ShiftName
@@ -93,11 +85,9 @@ join Shift S on R.ShiftId=S.ShiftID
 order by ShiftName
 """
 @app.get('/requests/shifts')
-def get_requests_shifts():
-    with phy_sch_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(requests_query_shifts)
-            return [shift for shift, in cursor] # pyright: ignore[reportGeneralTypeIssues]
+async def get_requests_shifts():
+    async with phy_sch_pool.connection() as conn:
+        return [shift for shift, in await conn.fetchall(requests_query_shifts)]
 
 requests_query_user = r"""
 select
@@ -127,11 +117,9 @@ and StartDate >= year(CURRENT_TIMESTAMP) * 10000 + month(CURRENT_TIMESTAMP) * 10
 order by StartDate, R.StartTime
 """
 @app.get('/requests/user/<string:user_code>') # pyright: ignore[reportArgumentType]
-def get_requests_user(user_code: str):
-    with phy_sch_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(requests_query_user, user_code)
-            return cursor.fetchall()
+async def get_requests_user(user_code: str):
+    async with phy_sch_pool.connection() as conn:
+        return await conn.fetchall(requests_query_user, user_code)
 
 requests_query_shift = r"""
 select
@@ -163,11 +151,9 @@ and StartDate >= year(CURRENT_TIMESTAMP) * 10000 + month(CURRENT_TIMESTAMP) * 10
 order by StartDate, R.StartTime
 """
 @app.get('/requests/shift/<string:user_code>') # pyright: ignore[reportArgumentType]
-def get_requests_shift(user_code: str):
-    with phy_sch_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(requests_query_shift, user_code)
-            return cursor.fetchall()
+async def get_requests_shift(user_code: str):
+    async with phy_sch_pool.connection() as conn:
+        return await conn.fetchall(requests_query_shift, user_code)
 
 calendar_query = r"""
 declare @today int = year(CURRENT_TIMESTAMP) * 10000 + month(CURRENT_TIMESTAMP) * 100 + day(CURRENT_TIMESTAMP)
@@ -182,35 +168,34 @@ where AssignDate >= coalesce(%d, @today)
 order by Shift.StartTime, Shift.EndTime, Shift.DisplayOrder, Shift.ShiftName, Shift.ShiftID
 """
 @app.get('/calendar')
-def get_calendar_all():
+async def get_calendar_all():
     start = request.args.get('start', None, type=int)
     finish = request.args.get('finish', start, type=int)
     user = request.args.get('user', None, type=str)
     shift = request.args.get('shift', None, type=int)
-    with phy_sch_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(calendar_query, (start, finish, user, user, shift, shift))
-            users={}
-            shifts=[]
-            dates=set()
-            current_shift_id = None
-            current_shift_assignments = None
-            for date_int, shift_id, shift_name, user_code, first_name, last_name in cursor: # pyright: ignore[reportGeneralTypeIssues]
-                dates.add(date_int)
-                if user_code not in users:
-                    users[user_code]=(first_name, last_name)
-                if shift_id != current_shift_id:
-                    current_shift_id = shift_id
-                    current_shift_assignments = (shift_id, shift_name, {})
-                    shifts.append(current_shift_assignments)
-                date_str = str(date_int)
-                if date_str not in (shift_dict := current_shift_assignments[2]): # pyright: ignore[reportOptionalSubscript]
-                    shift_dict[date_str]=[user_code]
-                else:
-                    shift_dict[date_str].append(user_code)
-            dates=sorted(dates)
-            return dict(
-                users=users,
-                shifts=shifts,
-                dates=dates,
-            )
\ No newline at end of file
+    async with phy_sch_pool.connection() as conn:
+        rows = await conn.fetchall(calendar_query, (start, finish, user, user, shift, shift))
+    users={}
+    shifts=[]
+    dates=set()
+    current_shift_id = None
+    current_shift_assignments = None
+    for date_int, shift_id, shift_name, user_code, first_name, last_name in rows:
+        dates.add(date_int)
+        if user_code not in users:
+            users[user_code]=(first_name, last_name)
+        if shift_id != current_shift_id:
+            current_shift_id = shift_id
+            current_shift_assignments = (shift_id, shift_name, {})
+            shifts.append(current_shift_assignments)
+        date_str = str(date_int)
+        if date_str not in (shift_dict := current_shift_assignments[2]): # pyright: ignore[reportOptionalSubscript]
+            shift_dict[date_str]=[user_code]
+        else:
+            shift_dict[date_str].append(user_code)
+    dates=sorted(dates)
+    return dict(
+        users=users,
+        shifts=shifts,
+        dates=dates,
+    )
\ No newline at end of file
@@ -0,0 +1,132 @@
+import re
+import logging
+from os import environ
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Iterable, LiteralString
+from lxml import etree # type: ignore
+from psycopg import AsyncConnection
+
+# Referral notes (notes.no_sub_category = 'R') are XHTML-ish documents. These are the
+# same XPath expressions the RIS queries used to evaluate server-side with xpath().
+
+HAS_EXAM_REQUESTED = etree.XPath('boolean(//p[@id="EXAMREQUESTED"])')
+EXAM_REQUESTED = etree.XPath('//p[@id="EXAMREQUESTED"]/text()')
+HAS_REASON_FOR_STUDY = etree.XPath('boolean(//p[b[text()="Reason For Study:"]])')
+REASON_FOR_STUDY = etree.XPath('//p[b[text()="Reason For Study:"]]/text()')
+HAS_CLINICAL_DETAILS = etree.XPath('boolean(//p[@id="CLINDETAILS"])')
+CLINICAL_DETAILS = etree.XPath('''//p[@id="CLINDETAILS"]/text()|//p[@id="CLINDETAILS"]/following-sibling::p[
+    not(@id)
+    and count(preceding-sibling::p[@id][1]|//p[@id="CLINDETAILS"])=1
+    and count(preceding-sibling::p[@id and @id!="CLINDETAILS" and position() < count(preceding-sibling::p[@id="CLINDETAILS"]/following-sibling::p)])=0
+    ]/text()''')
+HAS_CLINICAL_NOTES = etree.XPath('boolean(//p[b[contains(text(), "Clinical Notes")]])')
+CLINICAL_NOTES = etree.XPath('//p[b[contains(text(), "Clinical Notes")]]/text()')
+EGFR_RESULT = etree.XPath('//p[@id="EGFRRESULT"]/text()')
+EGFR_RE = re.compile(r'(\d+) mL/min/1.73m2')
+
+# Notes are always handed over as UTF-8, whatever encoding the document declares (XMLPARSE ignored it too)
+PARSER = etree.XMLParser(resolve_entities=False, no_network=True, encoding='utf-8')
+
+# xpath()::text returned text nodes XML-escaped, and existing label and triage_log tokens were built from that
+XML_ESCAPES = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '\r': '&#x0D;'})
+
+CACHE_SIZE = int(environ.get('REFERRAL_NOTE_CACHE_SIZE', 10000))
+
+doctext_query: LiteralString = r"""
+select te_key, te_text
+from doctext
+where te_key = any(%s) and te_key_type = 'N'
+"""
+
+
+@dataclass(frozen=True, slots=True)
+class ReferralNote:
+    requested_exam: str | None = None
+    clinical_details: str | None = None
+    egfr: int | None = None
+
+
+EMPTY_NOTE = ReferralNote()
+
+
+def escape(text) -> str:
+    """A text node as PostgreSQL's xpath() rendered it."""
+    return str(text).translate(XML_ESCAPES)
+
+
+def first(texts: list) -> str | None:
+    return escape(texts[0]) if texts else None
+
+
+def parse(text: str) -> ReferralNote:
+    try:
+        doc = etree.fromstring(text.encode(), PARSER)
+    except etree.XMLSyntaxError:
+        return EMPTY_NOTE
+    if HAS_EXAM_REQUESTED(doc):
+        requested_exam = first(EXAM_REQUESTED(doc))
+        requested_exam = requested_exam[2:] if requested_exam is not None else None
+    elif HAS_REASON_FOR_STUDY(doc):
+        requested_exam = first(REASON_FOR_STUDY(doc))
+        requested_exam = requested_exam[1:] if requested_exam is not None else None
+    else:
+        requested_exam = None
+    if HAS_CLINICAL_DETAILS(doc):
+        clinical_details = ' '.join(map(escape, CLINICAL_DETAILS(doc)))[2:]
+    elif HAS_CLINICAL_NOTES(doc):
+        clinical_details = first(CLINICAL_NOTES(doc))
+        clinical_details = clinical_details[1:] if clinical_details is not None else None
+    else:
+        clinical_details = None
+    egfr_text = first(EGFR_RESULT(doc))
+    egfr = int(match[1]) if egfr_text is not None and (match := EGFR_RE.search(egfr_text)) else None
+    return ReferralNote(requested_exam, clinical_details, egfr)
+
+
+class LRUCache(OrderedDict[int, ReferralNote]):
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key: int) -> ReferralNote | None:
+        if (value := self.get(key)) is not None:
+            self.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return value
+
+    def store(self, key: int, value: ReferralNote):
+        self[key] = value
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+# Active notes are never edited in place, so parsed notes can be kept by serial
+cache = LRUCache(CACHE_SIZE)
+
+
+async def fetch_notes(conn: AsyncConnection, serials: Iterable[int | None]) -> dict[int, ReferralNote]:
+    """Parsed referral notes by note serial, reading and parsing only those not already cached."""
+    notes: dict[int, ReferralNote] = {}
+    missing: list[int] = []
+    for serial in set(serials):
+        if serial is None:
+            continue
+        if (note := cache.lookup(serial)) is not None:
+            notes[serial] = note
+        else:
+            missing.append(serial)
+    if missing:
+        async with await conn.execute(doctext_query, [missing], prepare=True) as cur:
+            async for serial, text in cur:
+                if text is None:
+                    continue
+                notes[serial] = note = parse(text)
+                cache.store(serial, note)
+        logging.debug(f'Parsed {len(missing)} referral notes ({cache.hits} cache hits, {cache.misses} misses)')
+    return notes
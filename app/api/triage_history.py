@@ -1,7 +1,9 @@
 from typing import LiteralString
 from psycopg.rows import dict_row
 from . import app
+from .referral_notes import fetch_notes, EMPTY_NOTE
 from ..database import comrad_pool
+from ..coalesce import coalesce
 
 triage_history_query: LiteralString = r"""
 with codes as (
@@ -17,12 +19,10 @@ with codes as (
     order by rf_dor desc
     limit 100
 ), requests as (
-    select *,
-    XMLPARSE(document te_text) doc
+    select *
     from codes
     join case_referral using (rf_serial)
     left join notes on no_key = rf_serial and no_type = 'F' and no_category = 'Q' and no_sub_category = 'R' and no_status = 'A'
-    left join doctext on te_key = no_serial and te_key_type = 'N' and xml_is_well_formed_document(te_text)
 ) select
     rf_serial as id,
     extract(epoch from rf_dor at time zone 'Pacific/Auckland')::int as received,
@@ -34,19 +34,7 @@ with codes as (
     rf_original_priority request_priority,
     rf_exam_type modality,
     rf_reason requested_exam,
-    case
-        when xpath_exists('//p[@id="CLINDETAILS"]',doc)
-        then substr(array_to_string(xpath('//p[@id="CLINDETAILS"]/text()|//p[@id="CLINDETAILS"]/following-sibling::p[
-            not(@id)
-            and count(preceding-sibling::p[@id][1]|//p[@id="CLINDETAILS"])=1
-            and count(preceding-sibling::p[@id and @id!="CLINDETAILS" and position() < count(preceding-sibling::p[@id="CLINDETAILS"]/following-sibling::p)])=0
-            ]/text()', doc)::text[],' '),3)
-        when xpath_exists('//p[b[contains(text(), "Clinical Notes")]]',doc)
-        then substr((xpath('//p[b[contains(text(), "Clinical Notes")]]/text()', doc)::text[])[1],2)
-    end
-        as clinical_details,
-    substring((xpath('//p[@id="EGFRRESULT"]/text()', doc))[1]::text from '(\d+) mL/min/1.73m2')::int
-        as egfr,
+    no_serial as note,
     rf_triage_team as triage_team,
     extract(epoch from rf_triage_complete at time zone 'Pacific/Auckland')::int as triaged,
     st_firstnames::text as user_firstname,
@@ -72,8 +60,15 @@ join staff on rf_triage_completed_staff = st_serial
 
 
 @app.get('/triage_history')
+@coalesce
 async def get_triage_history():
     async with comrad_pool.connection() as conn:
         async with conn.cursor(row_factory=dict_row) as cur:
             await cur.execute(triage_history_query, prepare=True)
-            return await cur.fetchall()
\ No newline at end of file
+            results = await cur.fetchall()
+        notes = await fetch_notes(conn, (result['note'] for result in results))
+    for result in results:
+        note = notes.get(result.pop('note'), EMPTY_NOTE)
+        result['clinical_details'] = note.clinical_details
+        result['egfr'] = note.egfr
+    return results
\ No newline at end of file
@@ -1,10 +1,15 @@
 import logging
+import time
 import pandas as pd
-from quart import Quart
+from quart import Response, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from flask_orjson import OrjsonProvider
 from zoneinfo import ZoneInfo
 import holidays
-from .database import local_pool, comrad_pool
+from .database import local_pool, comrad_pool, reports_pool, phy_sch_pool, triage_log, slow_queries, ps360_service
+from . import coalesce
+from .metrics import REQUEST_LATENCY, stats
+from .profiling import ProfilingQuart, profiles, requested
 
 TZ = ZoneInfo("Pacific/Auckland")
 HOLIDAYS = holidays.country_holidays('NZ', subdiv='CAN')
@@ -12,7 +17,7 @@ HOLIDAYS = holidays.country_holidays('NZ', subdiv='CAN')
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)-8s %(message)s')
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
-app = Quart(__name__)
+app = ProfilingQuart(__name__)
 app.jinja_env.trim_blocks = True
 app.jinja_env.lstrip_blocks = True
 app.json = OrjsonProvider(app)
@@ -29,19 +34,76 @@ app.json.default = custom_orjson_default
 async def create_db_pool():
     await local_pool.open()
     await comrad_pool.open()
+    await reports_pool.open()
+    await phy_sch_pool.open()
+    await triage_log.open()
+    await ps360_service.open()
     logging.info("Opened connection pools")
 
-@app.after_serving
-async def close_db_pool():
-    await comrad_pool.close()
-    await local_pool.close()
-    logging.info("Closed connection pools")
+@app.before_request
+async def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+async def record_latency(response: Response):
+    if (start := g.get('request_start')) is not None:
+        route = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+        REQUEST_LATENCY.labels(request.method, route, str(response.status_code)).observe(time.perf_counter() - start)
+    return response
+
+stats.register('local', local_pool.get_stats)
+stats.register('comrad', comrad_pool.get_stats)
+stats.register('comrad_reports', reports_pool.get_stats)
+stats.register('physch', phy_sch_pool.get_stats)
+stats.register('coalesce', coalesce.get_stats)
+stats.register('triage_log', triage_log.get_stats)
+
+@app.get('/metrics')
+async def metrics():
+    return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+@app.get('/debug/slow-queries')
+async def get_slow_queries():
+    """Most recent statements over SLOW_QUERY_MS, newest first, with sampled EXPLAIN output."""
+    if not requested(request):
+        return dict(error='Forbidden'), 403
+    return slow_queries.entries()
+
+@app.get('/debug/profiles')
+async def get_profiles():
+    if not requested(request):
+        return dict(error='Forbidden'), 403
+    return [profile.summary() for profile in reversed(profiles.values())]
+
+@app.get('/debug/profiles/<id>')
+async def get_profile(id: str):
+    """cProfile report for one profiled request, sorted by ?sort= (default cumulative)."""
+    if not requested(request):
+        return dict(error='Forbidden'), 403
+    if (profile := profiles.get(id)) is None:
+        return dict(error='Unknown profile'), 404
+    return profile.report(request.args.get('sort', 'cumulative')), 200, {'Content-Type': 'text/plain; charset=utf-8'}
 
 @app.get('/health')
 async def health():
     return dict(
         local=local_pool.get_stats(),
         comrad=comrad_pool.get_stats(),
+        physch=phy_sch_pool.get_stats(),
+        coalesce=coalesce.get_stats(),
+        triage_log=triage_log.get_stats(),
     )
 
 from . import api, wally, registrar_numbers, reports
+
+# Quart runs after_serving hooks in registration order, so this one is registered after the
+# modules' own hooks: their background tasks stop while the pools they use are still open
+@app.after_serving
+async def close_db_pool():
+    await ps360_service.close()
+    await triage_log.close()
+    await phy_sch_pool.close()
+    await reports_pool.close()
+    await comrad_pool.close()
+    await local_pool.close()
+    logging.info("Closed connection pools")
@@ -0,0 +1,51 @@
+import asyncio
+from functools import wraps
+from quart import current_app, request, Response
+
+_in_flight: dict[tuple, asyncio.Task] = {}
+_stats = dict(
+    requests=0,
+    executions=0,
+    coalesced=0,
+)
+
+
+def coalesce(func):
+    """
+    Single-flight decorator for read-only endpoints.
+
+    Concurrent requests for the same endpoint with the same view and query
+    arguments share one execution of the handler: the first request runs it,
+    and the rest wait for its serialized response.
+    """
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        _stats['requests'] += 1
+        key = (
+            request.endpoint,
+            tuple(sorted((request.view_args or {}).items())),
+            tuple(sorted(request.args.items(multi=True))),
+        )
+        if (task := _in_flight.get(key)) is None:
+            _stats['executions'] += 1
+            task = asyncio.create_task(_execute(func, *args, **kwargs))
+            _in_flight[key] = task
+            task.add_done_callback(lambda _: _in_flight.pop(key, None))
+        else:
+            _stats['coalesced'] += 1
+        # shielded, so a disconnecting client does not cancel the execution others are waiting on
+        body, status, headers = await asyncio.shield(task)
+        return Response(body, status=status, headers=headers)
+    return wrapper
+
+
+async def _execute(func, *args, **kwargs) -> tuple[bytes, int, list[tuple[str, str]]]:
+    response = await current_app.make_response(await func(*args, **kwargs))
+    return await response.get_data(), response.status_code, list(response.headers.items())
+
+
+def get_stats() -> dict[str, int]:
+    return dict(
+        in_flight=len(_in_flight),
+        **_stats,
+    )
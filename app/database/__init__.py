@@ -1,4 +1,5 @@
-from .comrad import pool as comrad_pool
-from .local import pool as local_pool
-from .physician_scheduler import connection as phy_sch_connection
-from .ps360 import PS360
\ No newline at end of file
+from .comrad import pool as comrad_pool, reports_pool
+from .local import pool as local_pool, triage_log
+from .physician_scheduler import pool as phy_sch_pool
+from .ps360 import PS360, ps360_service
+from .slow_queries import slow_queries
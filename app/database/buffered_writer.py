@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Sequence
+from psycopg import sql
+from psycopg_pool import AsyncConnectionPool
+
+
+class BufferedWriter:
+    """
+    Append-only sink for audit rows.
+
+    Rows are queued in memory and copied into the table in batches by a
+    background task, whenever `batch_size` rows are waiting or every
+    `flush_interval` seconds. If a flush fails, its rows stay queued for the
+    next attempt. If the queue fills up, the oldest rows are dropped.
+    """
+
+    def __init__(
+        self,
+        pool: AsyncConnectionPool,
+        table: str,
+        columns: Sequence[str],
+        batch_size: int = 500,
+        flush_interval: float = 2,
+        max_queue: int = 50000,
+    ):
+        self._pool = pool
+        self._copy = sql.SQL("copy {} ({}) from stdin").format(
+            sql.Identifier(table),
+            sql.SQL(', ').join(map(sql.Identifier, columns)),
+        )
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: deque[Sequence] = deque(maxlen=max_queue)
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._stats = dict(
+            rows_written=0,
+            rows_dropped=0,
+            flushes=0,
+            flush_errors=0,
+            last_flush_ms=0,
+            max_flush_ms=0,
+        )
+
+    def write(self, row: Sequence):
+        if len(self._queue) == self._queue.maxlen:
+            self._stats['rows_dropped'] += 1
+        self._queue.append(row)
+        if len(self._queue) >= self.batch_size:
+            self._wake.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._queue:
+                rows = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                start = time.perf_counter()
+                try:
+                    async with self._pool.connection() as conn:
+                        async with conn.cursor() as cur:
+                            async with cur.copy(self._copy) as copy:
+                                for row in rows:
+                                    await copy.write_row(row)
+                except BaseException as e:
+                    self._requeue(rows)
+                    if not isinstance(e, Exception):
+                        raise # cancelled, the rows are flushed again on close
+                    self._stats['flush_errors'] += 1
+                    logging.exception(f'Error writing {len(rows)} rows to {self.table}, will retry')
+                    return
+                elapsed_ms = round((time.perf_counter() - start) * 1000)
+                self._stats['rows_written'] += len(rows)
+                self._stats['flushes'] += 1
+                self._stats['last_flush_ms'] = elapsed_ms
+                self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'], elapsed_ms)
+
+    def _requeue(self, rows: list[Sequence]):
+        """
+        Put a failed batch back at the front of the queue. extendleft on a full deque would
+        silently evict the newest rows, so when short of room the oldest rows of the batch
+        are dropped instead, consistent with write().
+        """
+        space = self._queue.maxlen - len(self._queue) # pyright: ignore[reportOptionalOperand]
+        if (dropped := len(rows) - space) > 0:
+            self._stats['rows_dropped'] += dropped
+            logging.error(f'Queue for {self.table} is full, dropping {dropped} unwritten rows')
+            rows = rows[dropped:]
+        self._queue.extendleft(reversed(rows))
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def open(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name=f'{self.table} writer')
+
+    async def close(self):
+        if (task := self._task) is not None:
+            self._task = None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        if self._queue:
+            logging.error(f'Discarding {len(self._queue)} unwritten rows for {self.table}')
+
+    def get_stats(self) -> dict[str, int]:
+        return dict(
+            queue_depth=len(self._queue),
+            **self._stats,
+        )
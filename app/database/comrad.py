@@ -1,10 +1,26 @@
 from os import environ
-from psycopg_pool import AsyncConnectionPool
+from .metered_pool import MeteredConnectionPool
+from .slow_queries import slow_queries
 
 
-pool = AsyncConnectionPool(
+pool = MeteredConnectionPool(
     environ['RIS_CONN'],
     min_size=1,
     max_size=4,
     open=False,
-)
\ No newline at end of file
+    name='comrad',
+    kwargs=dict(cursor_factory=slow_queries.cursor_factory('comrad')),
+)
+slow_queries.register(pool)
+
+# Streamed report downloads hold a connection (and a server-side cursor) for as long as
+# the client takes to read them, so they get their own small pool instead of starving the API
+reports_pool = MeteredConnectionPool(
+    environ['RIS_CONN'],
+    min_size=0,
+    max_size=int(environ.get('REPORTS_POOL_SIZE', 2)),
+    open=False,
+    name='comrad_reports',
+    kwargs=dict(cursor_factory=slow_queries.cursor_factory('comrad_reports')),
+)
+slow_queries.register(reports_pool)
\ No newline at end of file
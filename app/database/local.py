@@ -1,10 +1,33 @@
 from os import environ
-from psycopg_pool import AsyncConnectionPool
+from .metered_pool import MeteredConnectionPool
+from .slow_queries import slow_queries
+from .buffered_writer import BufferedWriter
 
 
-pool = AsyncConnectionPool(
+pool = MeteredConnectionPool(
     environ['DB_CONN'],
     min_size=1,
     max_size=4,
     open=False,
+    name='local',
+    kwargs=dict(cursor_factory=slow_queries.cursor_factory('local')),
+)
+slow_queries.register(pool)
+
+triage_log = BufferedWriter(
+    pool,
+    'triage_log',
+    (
+        'username',
+        'version',
+        'modality',
+        'referral',
+        'requested_exam',
+        'normalised_exam',
+        'tokenised',
+        'code',
+        'match_type',
+    ),
+    batch_size=int(environ.get('TRIAGE_LOG_BATCH_SIZE', 500)),
+    flush_interval=float(environ.get('TRIAGE_LOG_FLUSH_SECONDS', 2)),
 )
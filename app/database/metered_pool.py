@@ -0,0 +1,21 @@
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+from psycopg import AsyncConnection
+from psycopg_pool import AsyncConnectionPool
+from ..metrics import POOL_WAIT, POOL_CHECKOUT
+
+
+class MeteredConnectionPool(AsyncConnectionPool):
+    """AsyncConnectionPool recording connection wait and checkout times, labelled with the pool name."""
+
+    @asynccontextmanager
+    async def connection(self, timeout: float | None = None) -> AsyncIterator[AsyncConnection]:
+        start = time.perf_counter()
+        async with super().connection(timeout) as conn:
+            checked_out = time.perf_counter()
+            POOL_WAIT.labels(self.name).observe(checked_out - start)
+            try:
+                yield conn
+            finally:
+                POOL_CHECKOUT.labels(self.name).observe(time.perf_counter() - checked_out)
@@ -1,5 +1,13 @@
+import asyncio
+import logging
+import time
 import pymssql
 from os import environ
+from collections import deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator
+from ..metrics import POOL_WAIT, POOL_CHECKOUT, OUTBOUND_LATENCY
 
 def connection():
     return pymssql.connect(
@@ -9,3 +17,172 @@ def connection():
         database='PhySch',
         tds_version='7.4',
     )
+
+
+class PooledConnection:
+    """Async facade over a pymssql connection; every call runs on the pool's executor."""
+
+    def __init__(self, pool: 'PhySchPool', conn):
+        self._pool = pool
+        self._conn = conn
+        self._in_flight: asyncio.Future | None = None
+        self.last_used = time.monotonic()
+
+    async def fetchall(self, query: str, params: Any = None, as_dict: bool = False) -> list:
+        def run():
+            with self._conn.cursor(as_dict=as_dict) as cursor:
+                cursor.execute(query, params)
+                return cursor.fetchall()
+        start = time.perf_counter()
+        outcome = 'error'
+        try:
+            # Shielded, so if the caller is cancelled the pool can still tell when the thread is done with the connection
+            self._in_flight = self._pool.submit(run)
+            rows = await asyncio.shield(self._in_flight)
+            outcome = 'ok'
+            return rows
+        finally:
+            OUTBOUND_LATENCY.labels('physch', outcome, '').observe(time.perf_counter() - start)
+
+
+class PhySchPool:
+    """
+    Small connection pool for the PhySch SQL Server.
+
+    pymssql is blocking, so connections are opened, checked and used on a bounded
+    thread pool and handed out through an async context manager, mirroring
+    psycopg_pool's `async with pool.connection() as conn` usage.
+    """
+
+    def __init__(self, max_size: int = 4, max_idle: float = 600, check_after: float = 60):
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self._executor: ThreadPoolExecutor | None = None
+        self._semaphore = asyncio.Semaphore(max_size)
+        self._idle: deque[PooledConnection] = deque()
+        self._discarding: set[asyncio.Task] = set()
+        self._size = 0
+        self._stats = dict(
+            requests_num=0,
+            requests_waiting=0,
+            requests_wait_ms=0,
+            usage_ms=0,
+            connections_num=0,
+            connections_errors=0,
+            connections_lost=0,
+        )
+
+    async def open(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_size, thread_name_prefix='physch')
+
+    async def close(self):
+        while self._idle:
+            await self._discard(self._idle.pop())
+        await asyncio.gather(*self._discarding, return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def submit(self, func, *args) -> asyncio.Future:
+        if self._executor is None:
+            raise RuntimeError('PhySch pool is not open')
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def run(self, func, *args):
+        return await self.submit(func, *args)
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[PooledConnection]:
+        self._stats['requests_num'] += 1
+        self._stats['requests_waiting'] += 1
+        start = time.monotonic()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._stats['requests_waiting'] -= 1
+        release = True
+        try:
+            self._stats['requests_wait_ms'] += int((time.monotonic() - start) * 1000)
+            conn = await self._getconn()
+            checked_out = time.monotonic()
+            POOL_WAIT.labels('physch').observe(checked_out - start)
+            try:
+                yield conn
+            except BaseException as e:
+                # Cancellation doesn't stop the executor thread, and after any error the connection
+                # state is unknown, so it is closed (once its thread is done) rather than reused
+                if isinstance(e, (pymssql.OperationalError, pymssql.InterfaceError)):
+                    self._stats['connections_lost'] += 1
+                # The slot stays taken until then, so max_size still bounds the open connections
+                task = asyncio.create_task(self._discard(conn), name='PhySch discard')
+                self._discarding.add(task)
+                task.add_done_callback(self._discarding.discard)
+                task.add_done_callback(lambda _: self._semaphore.release())
+                release = False
+                raise
+            else:
+                await self._putconn(conn)
+            finally:
+                self._stats['usage_ms'] += int((time.monotonic() - checked_out) * 1000)
+                POOL_CHECKOUT.labels('physch').observe(time.monotonic() - checked_out)
+        finally:
+            if release:
+                self._semaphore.release()
+
+    async def _getconn(self) -> PooledConnection:
+        now = time.monotonic()
+        while self._idle:
+            conn = self._idle.pop()
+            idle = now - conn.last_used
+            if idle > self.max_idle:
+                await self._discard(conn)
+            elif idle > self.check_after and not await self.run(self._check, conn._conn):
+                self._stats['connections_lost'] += 1
+                await self._discard(conn)
+            else:
+                return conn
+        try:
+            conn = PooledConnection(self, await self.run(connection))
+        except Exception:
+            self._stats['connections_errors'] += 1
+            raise
+        self._stats['connections_num'] += 1
+        self._size += 1
+        return conn
+
+    async def _putconn(self, conn: PooledConnection):
+        conn.last_used = time.monotonic()
+        self._idle.append(conn)
+
+    async def _discard(self, conn: PooledConnection):
+        self._size -= 1
+        if (in_flight := conn._in_flight) is not None:
+            await asyncio.wait([in_flight])
+        try:
+            await self.run(conn._conn.close)
+        except Exception as e:
+            logging.warning(f'Error closing PhySch connection: {e}')
+
+    @staticmethod
+    def _check(conn) -> bool:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('select 1')
+                cursor.fetchall()
+            return True
+        except pymssql.Error:
+            return False
+
+    def get_stats(self) -> dict[str, int]:
+        return dict(
+            pool_min=0,
+            pool_max=self.max_size,
+            pool_size=self._size,
+            pool_available=len(self._idle),
+            **self._stats,
+        )
+
+
+pool = PhySchPool()
@@ -1,5 +1,8 @@
+import asyncio
 import logging
-from typing import AsyncGenerator
+import re
+import time
+from typing import AsyncGenerator, Awaitable, Callable
 import httpx
 from os import environ
 from datetime import datetime
@@ -7,9 +10,11 @@ from enum import StrEnum
 from dataclasses import dataclass
 from zeep import AsyncClient, Plugin
 from zeep.cache import SqliteCache
+from zeep.exceptions import Fault
 from zeep.transports import AsyncTransport
 from zeep.ns import SOAP_ENV_12
 from lxml import etree # type: ignore
+from ..metrics import MeteredTransport
 
 HOST = environ['PS360_HOST']
 USERNAME = environ['PS360_USER']
@@ -19,6 +24,15 @@ LOCALE = 'en-NZ'
 PS_VERSION = '7.0.212.0'
 SITE_ID = 0
 PS_PAGE_SIZE = 3000
+# GetReport calls in flight at once when resolving overreads
+PS_CONCURRENCY = int(environ.get('PS360_CONCURRENCY', 8))
+# Faults that mean the AccountSession is no longer usable, so signing in again may help
+# PS360's expiry faults aren't documented, so matching their text is backed by two checks that don't depend on it:
+# a session idle for longer than SESSION_MAX_IDLE is replaced before use, and any fault on a session with no
+# successful call in the last SESSION_CONFIRMED seconds is retried once after signing in again
+SESSION_MAX_IDLE = float(environ.get('PS360_SESSION_MAX_IDLE_SECONDS', 600))
+SESSION_CONFIRMED = float(environ.get('PS360_SESSION_CONFIRMED_SECONDS', 60))
+SESSION_FAULT_RE = re.compile(r'session.*\b(expired|invalid|not found|timed out)|\b(expired|invalid) .*session|not (signed|logged) in', re.IGNORECASE)
 
 class EventType(StrEnum):
     SIGN = 'Sign'
@@ -40,57 +54,126 @@ class User():
     last_event: UserLastEvent
 
 class PS360:
+    """
+    PS360 SOAP service, shared by the whole app.
+
+    The WSDLs are loaded once (on a thread, as zeep fetches them synchronously)
+    and the AccountSession is kept signed in between requests. Calls that fault
+    because the session expired, or on a session not confirmed recently, are
+    retried once after signing in again (other faults are raised as they are);
+    sessions left idle are replaced before use. Concurrent callers share one
+    re-authentication through a lock.
+    """
 
     _account_session: etree.Element | None
 
     def __init__(self):
         self._account_session = None
+        self._transport: AsyncTransport | None = None
+        self._lock = asyncio.Lock()
+        self._confirmed = 0.0 # monotonic time of the current session's sign in or last successful call
+
+    def _create_clients(self):
         self._transport = AsyncTransport(
             cache=SqliteCache(timeout=None), # type: ignore
             wsdl_client=httpx.Client(timeout=None),
-            client=httpx.AsyncClient(timeout=None),
+            client=httpx.AsyncClient(timeout=None, transport=MeteredTransport('ps360')),
             )
         self.session_client = AsyncClient(f'http://{HOST}/RAS/Session.svc?wsdl', transport=self._transport, plugins=[SaveAccountSessionPlugin(self)])
         self.explorer_client = AsyncClient(f'http://{HOST}/RAS/Explorer.svc?wsdl', transport=self._transport)
         self.report_client = AsyncClient(f'http://{HOST}/RAS/Report.svc?wsdl', transport=self._transport)
 
-    async def __aenter__(self):
-        await self.session_client.service.SignIn(
-            loginName=USERNAME,
-            password=PASSWORD,
-            adminMode=False,
-            version=PS_VERSION,
-            workstation='',
-            locale=LOCALE,
-            timeZoneId=TIME_ZONE_ID,
-        )
-        assert self._account_session is not None
-        logging.info(f'PS360 signed in: session ID {self._account_session.text}')
-        return self
-
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self._account_session is not None:
-            sessionId = self._account_session.text
-            if await self.session_client.service.SignOut(_soapheaders=[self._account_session]):
+    async def open(self):
+        """Load the WSDLs and sign in; failures are logged and retried on first use."""
+        try:
+            await self._session()
+        except Exception:
+            logging.exception('PS360 unavailable at startup, will retry on first use')
+
+    async def close(self):
+        async with self._lock:
+            if self._account_session is not None:
+                sessionId = self._account_session.text
+                try:
+                    if await self.session_client.service.SignOut(_soapheaders=[self._account_session]):
+                        logging.info(f'PS360 signed out: session ID {sessionId}')
+                except Exception:
+                    logging.exception('Error signing out of PS360')
                 self._account_session = None
-                logging.info(f'PS360 signed out: session ID {sessionId}')
-        await self._transport.aclose()
+            if self._transport is not None:
+                await self._transport.aclose()
+                self._transport.wsdl_client.close()
+                self._transport = None
+
+    async def _session(self, expired: etree.Element | None = None) -> etree.Element:
+        """The current AccountSession, signing in if there is none, it is the `expired` one or it has been idle too long."""
+        async with self._lock:
+            if self._transport is None:
+                await asyncio.to_thread(self._create_clients)
+            if (
+                self._account_session is None
+                or self._account_session is expired
+                or time.monotonic() - self._confirmed > SESSION_MAX_IDLE
+            ):
+                if self._account_session is not None:
+                    await self._sign_out(self._account_session)
+                self._account_session = None
+                await self.session_client.service.SignIn(
+                    loginName=USERNAME,
+                    password=PASSWORD,
+                    adminMode=False,
+                    version=PS_VERSION,
+                    workstation='',
+                    locale=LOCALE,
+                    timeZoneId=TIME_ZONE_ID,
+                )
+                if self._account_session is None:
+                    raise RuntimeError('PS360 SignIn returned no AccountSession')
+                self._confirmed = time.monotonic()
+                logging.info(f'PS360 signed in: session ID {self._account_session.text}')
+            return self._account_session
+
+    async def _sign_out(self, session: etree.Element):
+        """Best effort: the session being replaced has usually expired already."""
+        try:
+            await self.session_client.service.SignOut(_soapheaders=[session])
+        except Exception as e:
+            logging.info(f'PS360 sign out of replaced session {session.text} failed: {e}')
+
+    async def _call(self, client: str, operation_name: str, **kwargs):
+        """Call `operation_name` on the `<client>_client` with the AccountSession header."""
+        session = await self._session()
+        operation = getattr(getattr(self, f'{client}_client').service, operation_name)
+        try:
+            result = await operation(_soapheaders=[session], **kwargs)
+        except Fault as e:
+            if not (session_expired(e) or time.monotonic() - self._confirmed > SESSION_CONFIRMED):
+                raise
+            logging.warning(f'PS360 fault on a possibly expired session ({e.message}), signing in again and retrying')
+            session = await self._session(expired=session)
+            result = await operation(_soapheaders=[session], **kwargs)
+        if session is self._account_session:
+            self._confirmed = time.monotonic()
+        return result
 
     async def get_overread(self, reportId: int) -> datetime | None:
-        reportDetail = await self.report_client.service.GetReport(
+        reportDetail = await self._call(
+            'report',
+            'GetReport',
             reportID=reportId,
             fetchAudio=False,
             fetchImages=False,
             fetchNotes=False,
             fetchAttachments=False,
-            _soapheaders=[self._account_session],
         )
         return reportDetail.LastPrelimDate if reportDetail.Overread else None
 
-    async def orders(self, accountID: int, _from: datetime, _to: datetime) -> AsyncGenerator[tuple[int, str]]:
-        page_number = 1
-        while True:
-            response = await self.explorer_client.service.BrowseOrders(
+    async def order_pages(self, accountID: int, _from: datetime, _to: datetime) -> AsyncGenerator[list[tuple[int, str]]]:
+        """Pages of (ReportID, Accession), requesting each next page while the caller works on the current one."""
+        async def browse(page_number: int) -> list:
+            return await self._call(
+                'explorer',
+                'BrowseOrders',
                 siteID=SITE_ID,
                 time=dict(
                     Period='Custom',
@@ -104,22 +187,63 @@ class PS360:
                 sort='LastModifiedDate ASC',
                 pageSize=PS_PAGE_SIZE,
                 pageNumber=page_number,
-                _soapheaders=[self._account_session],
             ) or []
-            for report in response:
-                yield report.ReportID, report.Accession
-            if len(response) < PS_PAGE_SIZE:
-                logging.info(f'Finished scraping PS360. Pages fetched: {page_number}, reports: {PS_PAGE_SIZE * (page_number-1) + len(response)}')
-                return
-            page_number += 1
+        page_number = 1
+        next_page: asyncio.Task | None = asyncio.create_task(browse(page_number))
+        try:
+            while next_page is not None:
+                response = await next_page
+                next_page = asyncio.create_task(browse(page_number + 1)) if len(response) == PS_PAGE_SIZE else None
+                yield [(report.ReportID, report.Accession) for report in response]
+                if next_page is None:
+                    logging.info(f'Finished scraping PS360. Pages fetched: {page_number}, reports: {PS_PAGE_SIZE * (page_number-1) + len(response)}')
+                page_number += 1
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def overreads(
+        self,
+        accountID: int,
+        _from: datetime,
+        _to: datetime,
+        known: Callable[[list[int]], Awaitable[set[int]]] | None = None,
+    ) -> AsyncGenerator[tuple[int, str, datetime]]:
+        """
+        (ReportID, Accession, LastPrelimDate) of the account's overread reports.
+
+        Each page's reports are resolved with up to PS_CONCURRENCY GetReport calls at once,
+        while the next page is fetched; report IDs returned by `known` are skipped.
+        """
+        semaphore = asyncio.Semaphore(PS_CONCURRENCY)
+
+        async def resolve(reportId: int) -> datetime | None:
+            async with semaphore:
+                return await self.get_overread(reportId)
+
+        async for page in self.order_pages(accountID, _from, _to):
+            skip = await known([reportId for reportId, _ in page]) if known is not None and page else set()
+            pending = [(reportId, accession) for reportId, accession in page if reportId not in skip]
+            logging.info(f'Resolving {len(pending)} PS360 reports ({len(page) - len(pending)} already known)')
+            for (reportId, accession), overread in zip(pending, await asyncio.gather(*(resolve(reportId) for reportId, _ in pending))):
+                if overread is not None:
+                    yield reportId, accession, overread
+
+def session_expired(fault: Fault) -> bool:
+    return any(SESSION_FAULT_RE.search(text) for text in (fault.message, fault.code) if text)
+
 
 class SaveAccountSessionPlugin(Plugin):
     def __init__(self, ps : PS360):
         self.ps = ps
 
     def ingress(self, envelope, http_headers, operation):
-        self.ps._account_session = envelope.find('./s:Header/AccountSession', {'s': SOAP_ENV_12})
+        if (account_session := envelope.find('./s:Header/AccountSession', {'s': SOAP_ENV_12})) is not None:
+            self.ps._account_session = account_session
         return envelope, http_headers
 
     def egress(self, envelope, http_headers, operation, binding_options):
         return envelope, http_headers
+
+
+ps360_service = PS360()
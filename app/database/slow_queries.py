@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import random
+import re
+import time
+from os import environ
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any
+from psycopg import AsyncConnection, AsyncCursor, sql
+from psycopg_pool import AsyncConnectionPool
+
+THRESHOLD_MS = float(environ.get('SLOW_QUERY_MS', 500))
+EXPLAIN_RATE = float(environ.get('SLOW_QUERY_EXPLAIN_RATE', 0.1))
+EXPLAIN_TIMEOUT_MS = int(environ.get('SLOW_QUERY_EXPLAIN_TIMEOUT_MS', 10000))
+LOG_SIZE = int(environ.get('SLOW_QUERY_LOG_SIZE', 100))
+
+# EXPLAIN ANALYZE runs the statement, so only plain reads are explained (and always rolled back)
+EXPLAINABLE_RE = re.compile(r'^\s*(select|with)\b', re.IGNORECASE)
+
+
+@dataclass(slots=True)
+class SlowQuery:
+    at: datetime
+    pool: str
+    duration_ms: float
+    statement: str
+    params: Any
+    rows: int
+    explain: str | None = field(default=None)
+
+
+def shape(value: Any) -> Any:
+    """Parameter types and sizes without the values, which may identify patients."""
+    if isinstance(value, dict):
+        return {key: shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return f'{type(value).__name__}[{len(value)}]'
+    return type(value).__name__
+
+
+class SlowQueryLog:
+    """
+    Ring buffer of the most recent statements slower than THRESHOLD_MS.
+
+    A fraction (EXPLAIN_RATE) of slow reads are re-run in the background under
+    EXPLAIN (ANALYZE, BUFFERS), one at a time, and the plan is attached to the entry.
+    ANALYZE executes the statement a second time, so each explain costs the database
+    about as much as the slow query did. It runs on its own connection rather than
+    the pool's, rolled back and cut off after EXPLAIN_TIMEOUT_MS.
+    """
+
+    def __init__(self, maxlen: int):
+        self._entries: deque[SlowQuery] = deque(maxlen=maxlen)
+        self._pools: dict[str, AsyncConnectionPool] = {}
+        self._explaining: asyncio.Task | None = None
+
+    def register(self, pool: AsyncConnectionPool):
+        self._pools[pool.name] = pool
+
+    def cursor_factory(self, pool_name: str) -> type[AsyncCursor]:
+        log = self
+
+        class TimedCursor(AsyncCursor):
+            async def execute(self, query, params=None, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await super().execute(query, params, **kwargs)
+                finally:
+                    if (duration_ms := (time.perf_counter() - start) * 1000) >= THRESHOLD_MS:
+                        log.record(pool_name, duration_ms, self, query, params)
+
+        return TimedCursor
+
+    def record(self, pool_name: str, duration_ms: float, cur: AsyncCursor, query, params):
+        if isinstance(query, sql.Composable):
+            statement = query.as_string(cur.connection)
+        elif isinstance(query, bytes):
+            statement = query.decode()
+        else:
+            statement = str(query)
+        entry = SlowQuery(
+            datetime.now(tz=timezone.utc),
+            pool_name,
+            round(duration_ms, 1),
+            statement,
+            shape(params),
+            cur.rowcount,
+        )
+        self._entries.append(entry)
+        logging.warning(f'Slow query on {pool_name} ({entry.duration_ms} ms): {" ".join(statement.split())[:200]}')
+        if (
+            EXPLAIN_RATE > 0
+            and (self._explaining is None or self._explaining.done())
+            and pool_name in self._pools
+            and EXPLAINABLE_RE.match(statement)
+            and random.random() < EXPLAIN_RATE
+        ):
+            self._explaining = asyncio.create_task(self._explain(entry, params), name='Slow query explain')
+
+    async def _explain(self, entry: SlowQuery, params):
+        try:
+            # A plain connection, so the EXPLAIN neither takes a pool slot nor is logged as slow
+            async with await AsyncConnection.connect(self._pools[entry.pool].conninfo) as conn:
+                async with conn.transaction(force_rollback=True):
+                    async with conn.cursor() as cur:
+                        await cur.execute(sql.SQL('set local statement_timeout = {}').format(EXPLAIN_TIMEOUT_MS))
+                        await cur.execute(sql.SQL('explain (analyze, buffers) {}').format(sql.SQL(entry.statement)), params) # pyright: ignore[reportArgumentType]
+                        entry.explain = '\n'.join(line for line, in await cur.fetchall())
+        except Exception as e:
+            entry.explain = f'EXPLAIN failed: {e}'
+
+    def entries(self) -> list[SlowQuery]:
+        return list(reversed(self._entries))
+
+
+slow_queries = SlowQueryLog(LOG_SIZE)
@@ -0,0 +1,82 @@
+import time
+from typing import Callable
+import httpx
+from prometheus_client import Histogram, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+
+# Pool waits are usually sub-millisecond, so the default buckets start too coarse
+WAIT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds',
+    'Time from request to response headers, by route and status',
+    ['method', 'route', 'status'],
+)
+
+POOL_WAIT = Histogram(
+    'db_pool_wait_seconds',
+    'Time spent waiting for a pooled connection',
+    ['pool'],
+    buckets=WAIT_BUCKETS,
+)
+
+POOL_CHECKOUT = Histogram(
+    'db_pool_checkout_seconds',
+    'Time a pooled connection is held before being returned',
+    ['pool'],
+    buckets=WAIT_BUCKETS,
+)
+
+# outcome is 'ok' or 'error' for every service; status is the HTTP status code, or empty where there is none
+OUTBOUND_LATENCY = Histogram(
+    'outbound_request_duration_seconds',
+    'Latency of calls to external services',
+    ['service', 'outcome', 'status'],
+)
+
+
+class MeteredTransport(httpx.AsyncBaseTransport):
+    """
+    httpx transport recording time to response headers in OUTBOUND_LATENCY.
+
+    Wraps the default transport rather than using event hooks, so connection
+    errors and timeouts are recorded as errors too. 5xx responses count as errors.
+    """
+
+    def __init__(self, service: str, transport: httpx.AsyncBaseTransport | None = None):
+        self.service = service
+        self._transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        start = time.perf_counter()
+        outcome, status = 'error', ''
+        try:
+            response = await self._transport.handle_async_request(request)
+            outcome, status = 'error' if response.status_code >= 500 else 'ok', str(response.status_code)
+            return response
+        finally:
+            OUTBOUND_LATENCY.labels(self.service, outcome, status).observe(time.perf_counter() - start)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+class StatsCollector:
+    """Exposes `get_stats()` dictionaries (pools, writers, ...) as gauges at scrape time."""
+
+    def __init__(self):
+        self._sources: dict[str, Callable[[], dict[str, int]]] = {}
+
+    def register(self, name: str, get_stats: Callable[[], dict[str, int]]):
+        self._sources[name] = get_stats
+
+    def collect(self):
+        gauge = GaugeMetricFamily('component_stats', 'Internal statistics reported by get_stats()', labels=['component', 'stat'])
+        for name, get_stats in self._sources.items():
+            for stat, value in get_stats().items():
+                gauge.add_metric([name, stat], value)
+        yield gauge
+
+
+stats = StatsCollector()
+REGISTRY.register(stats)
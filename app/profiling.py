@@ -0,0 +1,164 @@
+import cProfile
+import hmac
+import io
+import logging
+import pstats
+import time
+import types
+import uuid
+from os import environ
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from quart import Quart, after_this_request, request, websocket
+
+# Profiling is off entirely unless a token is configured
+PROFILE_TOKEN = environ.get('PROFILE_TOKEN')
+PROFILE_HEADER = 'X-Profile'
+PROFILE_STORE_SIZE = int(environ.get('PROFILE_STORE_SIZE', 20))
+
+
+@dataclass(slots=True)
+class Profile:
+    id: str
+    at: datetime
+    path: str
+    wall: float = 0
+    running: float = 0
+    cpu: float = 0
+    steps: int = 0
+    profiler: cProfile.Profile = field(default_factory=cProfile.Profile, repr=False)
+
+    @property
+    def awaiting(self) -> float:
+        return max(self.wall - self.running, 0)
+
+    def summary(self) -> dict:
+        return dict(
+            id=self.id,
+            at=self.at,
+            path=self.path,
+            wall_ms=round(self.wall * 1000, 1),
+            running_ms=round(self.running * 1000, 1),
+            cpu_ms=round(self.cpu * 1000, 1),
+            awaiting_ms=round(self.awaiting * 1000, 1),
+            steps=self.steps,
+        )
+
+    def report(self, sort: str = 'cumulative', limit: int = 60) -> str:
+        out = io.StringIO()
+        s = self.summary()
+        out.write(f"{s['path']} at {s['at']:%Y-%m-%d %H:%M:%S} UTC: {s['wall_ms']} ms wall, "
+                  f"{s['running_ms']} ms running ({s['cpu_ms']} ms CPU), {s['awaiting_ms']} ms awaiting, "
+                  f"{s['steps']} steps\n\n")
+        pstats.Stats(self.profiler, stream=out).sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+
+class ProfileStore(OrderedDict[str, Profile]):
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def store(self, profile: Profile):
+        self[profile.id] = profile
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+profiles = ProfileStore(PROFILE_STORE_SIZE)
+
+
+def authorised(token: str | None) -> bool:
+    return PROFILE_TOKEN is not None and token is not None and hmac.compare_digest(token, PROFILE_TOKEN)
+
+
+def requested(r) -> bool:
+    """Whether the request or websocket asks to be profiled. Cheap when profiling is off."""
+    return PROFILE_TOKEN is not None and authorised(r.headers.get(PROFILE_HEADER) or r.args.get('profile'))
+
+
+@types.coroutine
+def profiled(coro, profile: Profile):
+    """
+    Drive `coro` step by step, so the profiler only runs while the handler itself
+    does, not while other requests' tasks run during its awaits.
+
+    Time between steps (database, HTTP, executor threads, other tasks) counts as awaiting.
+    """
+    start = time.perf_counter()
+    value, error = None, None
+    try:
+        while True:
+            step_start, cpu_start = time.perf_counter(), time.thread_time()
+            profile.profiler.enable()
+            try:
+                if error is not None:
+                    future = coro.throw(error)
+                else:
+                    future = coro.send(value)
+            except StopIteration as e:
+                return e.value
+            finally:
+                profile.profiler.disable()
+                profile.running += time.perf_counter() - step_start
+                profile.cpu += time.thread_time() - cpu_start
+                profile.steps += 1
+            try:
+                value, error = (yield future), None
+            except BaseException as e:
+                value, error = None, e
+    finally:
+        profile.wall = time.perf_counter() - start
+        coro.close()
+
+
+class ProfilingQuart(Quart):
+    """
+    Quart app that profiles a request or websocket when it carries the PROFILE_TOKEN,
+    in the X-Profile header or the ?profile= query parameter.
+
+    Profiled responses carry a Server-Timing header and X-Profile-Id; the full
+    cProfile report is kept in `profiles` and served from /debug/profiles/<id>.
+    Streamed response bodies are generated after dispatch and are not covered.
+    """
+
+    async def dispatch_request(self, *args, **kwargs):
+        if not requested(request) or request.path.startswith('/debug/profiles'):
+            return await super().dispatch_request(*args, **kwargs)
+        profile = self._start_profile(request.path)
+
+        @after_this_request
+        def add_headers(response):
+            response.headers['Server-Timing'] = ', '.join([
+                f'total;dur={profile.wall * 1000:.1f}',
+                f'cpu;dur={profile.cpu * 1000:.1f}',
+                f'await;dur={profile.awaiting * 1000:.1f}',
+            ])
+            response.headers['X-Profile-Id'] = profile.id
+            return response
+
+        try:
+            return await profiled(super().dispatch_request(*args, **kwargs), profile)
+        finally:
+            self._finish_profile(profile)
+
+    async def dispatch_websocket(self, *args, **kwargs):
+        if not requested(websocket):
+            return await super().dispatch_websocket(*args, **kwargs)
+        profile = self._start_profile(websocket.path)
+        try:
+            return await profiled(super().dispatch_websocket(*args, **kwargs), profile)
+        finally:
+            self._finish_profile(profile)
+
+    @staticmethod
+    def _start_profile(path: str) -> Profile:
+        return Profile(uuid.uuid4().hex, datetime.now(tz=timezone.utc), path)
+
+    @staticmethod
+    def _finish_profile(profile: Profile):
+        profiles.store(profile)
+        s = profile.summary()
+        logging.info(f"Profiled {s['path']} as {s['id']}: {s['wall_ms']} ms wall, {s['cpu_ms']} ms CPU, {s['awaiting_ms']} ms awaiting")
+
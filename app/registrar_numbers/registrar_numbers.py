@@ -1,23 +1,34 @@
-from psycopg import AsyncConnection
+from psycopg import AsyncConnection, AsyncCursor
 from . import app, TZ
-from ..database import local_pool, comrad_pool, PS360
+from ..database import local_pool, comrad_pool, PS360, ps360_service
 from quart import request, render_template, jsonify, websocket, has_websocket_context
 
 from os import environ
+import asyncio
 import httpx
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
+from typing import AsyncIterator
 from datetime import datetime, date, time
 from lxml import html, etree  # pyright: ignore[reportAttributeAccessIssue]
 from psycopg.types.json import Jsonb
 import logging
 import pandas as pd
 from .parts_parser import clean, parse_cleaned
+from ..metrics import MeteredTransport
 
 IB_HOST = environ.get('IB_HOST', 'app-inteleradha-p.healthhub.health.nz')
 IB_USER = environ['IB_USER']
 IB_PASSWORD = environ['IB_PASSWORD']
 
 RETRIEVE_STEPS = 5
+# Accession tiles fetched at once from InteleBrowser, and attempts per tile
+IB_TILE_CONCURRENCY = int(environ.get('IB_TILE_CONCURRENCY', 8))
+IB_TILE_ATTEMPTS = int(environ.get('IB_TILE_ATTEMPTS', 3))
+# Logged-in InteleBrowser sessions kept for reuse, i.e. concurrent registrar numbers runs
+IB_POOL_SIZE = int(environ.get('IB_POOL_SIZE', 2))
+# How long a discarded session gets to log out before it is closed anyway
+IB_LOGOUT_TIMEOUT = float(environ.get('IB_LOGOUT_TIMEOUT', 5))
 
 
 async def websocket_send_error(msg: str):
@@ -53,7 +64,7 @@ async def ws():
             date.fromisoformat(r["toDate"]),
         )
         await websocket_send_update(f'Generating registrar numbers for {user.pacs} ({user.ris}) from {user.fromDate} to {user.toDate}', 0)
-        async with InteleBrowserClient(timeout=None) as client:
+        async with ib_pool.checkout() as client:
             data = await client.process_user(user, conn)
     if data is None:
         await websocket_send_result(data)
@@ -189,13 +200,117 @@ order by report_timestamp
 """
 
 
+# Scraped rows are collected per page, copied into a staging table and merged with one statement
+STAGING_BATCH_SIZE = 1000
+
+STAGING_TABLE = r"""
+create temp table if not exists registrar_numbers_staging (
+    accession text not null,
+    ps360_report_id bigint,
+    pacs_audit_uid text,
+    event_timestamp timestamptz not null
+) on commit drop
+"""
+
+STAGING_COPY = r"""
+copy registrar_numbers_staging (accession, ps360_report_id, pacs_audit_uid, event_timestamp) from stdin
+"""
+
+# The aggregates keep each statement to one row per conflict target; the conflict rules are those
+# of the previous row-at-a-time upserts: fill a null report ID/audit UID, keep the earliest event.
+MERGE_PS360_REPORT_IDS = r"""
+insert into registrar_numbers_accessions (accession, ps360_report_id)
+select accession, min(ps360_report_id)
+from registrar_numbers_staging
+where ps360_report_id is not null
+group by accession
+on conflict (accession)
+do update set ps360_report_id = excluded.ps360_report_id
+where registrar_numbers_accessions.ps360_report_id is null
+"""
+
+MERGE_PACS_AUDIT_UIDS = r"""
+insert into registrar_numbers_accessions (accession, pacs_audit_uid)
+select accession, min(pacs_audit_uid)
+from registrar_numbers_staging
+where pacs_audit_uid is not null
+group by accession
+on conflict (accession)
+do update set pacs_audit_uid = excluded.pacs_audit_uid
+where registrar_numbers_accessions.pacs_audit_uid is null
+"""
+
+MERGE_OVERREADS = r"""
+insert into registrar_numbers (user_pacs, accession, overread)
+select %s, accession, min(event_timestamp)
+from registrar_numbers_staging
+group by accession
+on conflict (user_pacs, accession)
+do update set overread = excluded.overread
+where registrar_numbers.overread is null
+or registrar_numbers.overread > excluded.overread
+"""
+
+MERGE_IMPRESSIONS = r"""
+insert into registrar_numbers (user_pacs, accession, impression)
+select %s, accession, min(event_timestamp)
+from registrar_numbers_staging
+group by accession
+on conflict (user_pacs, accession)
+do update set impression = excluded.impression
+where registrar_numbers.impression is null
+or registrar_numbers.impression > excluded.impression
+"""
+
+
+async def stage(cur: AsyncCursor, rows: list[tuple[str, int | None, str | None, datetime]]):
+    """Replace the contents of the staging table with rows of (accession, ps360_report_id, pacs_audit_uid, event_timestamp)."""
+    await cur.execute(STAGING_TABLE)
+    await cur.execute("truncate registrar_numbers_staging")
+    async with cur.copy(STAGING_COPY) as copy:
+        for row in rows:
+            await copy.write_row(row)
+
+
+async def merge_overreads(cur: AsyncCursor, user_pacs: str, rows: list[tuple[str, int, datetime]]) -> int:
+    """Upsert a batch of (accession, ps360_report_id, overread); returns the number of registrar_numbers rows changed."""
+    await stage(cur, [(accession, report_id, None, overread) for accession, report_id, overread in rows])
+    await cur.execute(MERGE_PS360_REPORT_IDS)
+    await cur.execute(MERGE_OVERREADS, [user_pacs])
+    return cur.rowcount
+
+
+async def merge_impressions(cur: AsyncCursor, user_pacs: str, rows: list[tuple[str, str | None, datetime]]) -> int:
+    """
+    Upsert a batch of (accession, pacs_audit_uid, impression), where pacs_audit_uid is only given for
+    newly scraped accessions; returns the number of registrar_numbers rows changed.
+    """
+    await stage(cur, [(accession, None, uid, impression) for accession, uid, impression in rows])
+    await cur.execute(MERGE_PACS_AUDIT_UIDS)
+    await cur.execute(MERGE_IMPRESSIONS, [user_pacs])
+    return cur.rowcount
+
+
+class InteleBrowserSessionExpired(httpx.HTTPError):
+    """The session expired during a request that depends on server-side state, so it wasn't replayed."""
+
+
 class InteleBrowserClient(httpx.AsyncClient):
     LOGIN_URL = f"http://{IB_HOST}/InteleBrowser/login/ws/auth"
     LOGOUT_URL = f"http://{IB_HOST}/InteleBrowser/login/ws/auth/revoke"
     APP_URL = f"http://{IB_HOST}/InteleBrowser/app"
+    # Request extension marking login and logout requests, which are never retried
+    AUTH = {'auth': True}
+    # Request extension marking POSTs that are safe to replay on a new session (GETs always are)
+    REPLAYABLE = {'replayable': True}
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.logins = 0
+        self._login_lock = asyncio.Lock()
 
-    async def __aenter__(self):
-        await super().__aenter__()
+    async def login(self):
+        # Marked per request, so only these bypass the expired session check, not concurrent requests
         (await self.post(
             self.LOGIN_URL,
             data={
@@ -204,6 +319,7 @@ class InteleBrowserClient(httpx.AsyncClient):
                 "mfaToken": "",
                 "keepMeLoggedIn": "false",
             },
+            extensions=self.AUTH,
         )).raise_for_status()  # log in
         (await self.post(
             self.APP_URL,
@@ -214,24 +330,101 @@ class InteleBrowserClient(httpx.AsyncClient):
                 "pageSizeSelect": "4",
                 "pageSizeSelect$0": "4",
             },
+            extensions=self.AUTH,
         )).raise_for_status()  # set page size to 1000
-        return self
-
-    async def __aexit__(
-        self,
-        exc_type=None,
-        exc_value=None,
-        traceback=None,
-    ):
+        self.logins += 1
+        logging.info(f'InteleBrowser logged in (session {id(self):x}, login {self.logins})')
+
+    async def logout(self):
         (await self.get(
             self.LOGOUT_URL,
             follow_redirects=True,
+            extensions=self.AUTH,
         )).raise_for_status()
-        await super().__aexit__(exc_type, exc_value, traceback)
+
+    @staticmethod
+    def logged_out(response: httpx.Response) -> bool:
+        return response.status_code == 401 or (response.is_redirect and '/login' in response.headers.get('location', ''))
+
+    async def request(self, method, url, **kwargs) -> httpx.Response:
+        """
+        Log in again if the session has expired, and retry once if the request is safe to replay.
+        Anything else (e.g. nextPage, whose search the new session doesn't have) raises InteleBrowserSessionExpired.
+        """
+        logins = self.logins
+        response = await super().request(method, url, **kwargs)
+        extensions = kwargs.get('extensions') or {}
+        if extensions.get('auth') or not self.logged_out(response):
+            return response
+        async with self._login_lock:
+            if self.logins == logins:  # not already renewed by a concurrent request
+                logging.info('InteleBrowser session expired, logging in again')
+                await self.login()
+        if method.upper() != 'GET' and not extensions.get('replayable'):
+            raise InteleBrowserSessionExpired(f'InteleBrowser session expired during {method} {url}')
+        return await super().request(method, url, **kwargs)
+
+    async def search_audit(self, user_pacs: str, from_date: date, to_date: date) -> httpx.Response:
+        """Submit the audit search, which resets the session's pagination to the first page of results."""
+        return await self.post(
+            self.APP_URL,
+            data={
+                "service": "direct/1/AuditDetails/$Form",
+                "sp": "S1",
+                "Form1": "usernameFilter,$PropertySelection,patientIdFilter,studyDescriptionFilter,$PropertySelection$0,$Checkbox,$Checkbox$0,$Checkbox$1,$Checkbox$2,$Checkbox$3,$Checkbox$4,$Checkbox$5,$Checkbox$6,$Checkbox$7,$Checkbox$8,$Checkbox$9,$Checkbox$10,$Checkbox$11,$Checkbox$12,$Checkbox$13,$Checkbox$14,$Checkbox$15,$Checkbox$16,$Checkbox$17,$Checkbox$18,$Checkbox$19,$Checkbox$20,$Checkbox$21,$Checkbox$22,$Checkbox$23,$Checkbox$24,$Checkbox$25,$Checkbox$26,$Checkbox$27,$Checkbox$28,$Checkbox$29,$Checkbox$30,$Checkbox$31,$Checkbox$32,$Checkbox$33,$Checkbox$34,$Checkbox$35,$Checkbox$36,$Checkbox$37,$Checkbox$38,$Checkbox$39,$Checkbox$40,$Checkbox$41,$Checkbox$42,$Checkbox$43,$Checkbox$44,$Checkbox$45,$Checkbox$46,$Checkbox$47,$Checkbox$48,$Checkbox$49,$Checkbox$50,$Checkbox$51,$Submit",
+                "usernameFilter": user_pacs,
+                "$PropertySelection": "anyRole",
+                "patientIdFilter": "",
+                "studyDescriptionFilter": "",
+                "$PropertySelection$0": f'{from_date.strftime("%Y/%m/%d")}:{to_date.strftime("%Y/%m/%d")}',
+                "$Checkbox$2": "on",  # Add Emergency Impression
+                "$Submit": "Update",
+            },
+            extensions=self.REPLAYABLE,
+        )
+
+    async def fetch_accession(self, uid: str, semaphore: asyncio.Semaphore) -> str | None:
+        """
+        Accession for an audit study UID from its tile, retrying transport errors and 5xx responses with backoff.
+        Any other failure (an error or login page, an unparseable tile) is logged and gives None, so one bad
+        tile never fails the page while its siblings are still fetching.
+        """
+        async with semaphore:
+            for attempt in range(IB_TILE_ATTEMPTS):
+                try:
+                    extra_response = await self.get(
+                        self.APP_URL,
+                        params={
+                            "service": "xtile/null/AuditDetails/$XTile$2", "sp": uid},
+                    )
+                    if extra_response.status_code < 500:
+                        break
+                    error = f'HTTP {extra_response.status_code}'
+                except httpx.TransportError as e:
+                    error = repr(e)
+                if attempt + 1 == IB_TILE_ATTEMPTS:
+                    logging.error(f'Giving up fetching accession tile for uid {uid} after {IB_TILE_ATTEMPTS} attempts: {error}')
+                    return None
+                logging.warning(f'Error fetching accession tile for uid {uid} ({error}), retrying')
+                await asyncio.sleep(0.5 * 2 ** attempt)
+        if not extra_response.is_success:
+            logging.error(f'Error fetching accession tile for uid {uid}: HTTP {extra_response.status_code}')
+            return None
+        try:
+            extra_root = etree.fromstring(extra_response.content)
+        except etree.XMLSyntaxError as e:
+            logging.error(f'Unparseable accession tile for uid {uid}: {e}')
+            return None
+        if (accession_node := extra_root.find("./sp[2]")) is not None and accession_node.text is not None:
+            logging.debug(
+                f"Fetched accession from internet: {accession_node.text}")
+            return accession_node.text
+        logging.error(
+            f'Error fetching accession for uid: {uid}')
+        return None
 
     async def process_user(self, user: User, conn: AsyncConnection) -> pd.DataFrame | None:
-        async with PS360() as ps360:
-            impressions = await self.fetch_impressions(user, conn, ps360)
+        impressions = await self.fetch_impressions(user, conn, ps360_service)
         return await self.fetch_ris_data(user, impressions, conn)
 
     async def fetch_impressions(self, user: User, conn: AsyncConnection, ps360: PS360) -> list[Report]:
@@ -252,25 +445,22 @@ class InteleBrowserClient(httpx.AsyncClient):
                     today, time.max, tzinfo=TZ)
                 logging.info(
                     f"Retrieving PS360 overread reports for {user.pacs} from {scrape_from_datetime} to {scrape_to_datetime}")
-                async for reportId, accession in ps360.orders(user.ps360, scrape_from_datetime, scrape_to_datetime):
-                    if (overread := await ps360.get_overread(reportId)) is not None:
-                        await cur.execute(r"""
-                            insert into registrar_numbers_accessions (accession, ps360_report_id) values (%s, %s)
-                            on conflict (accession)
-                            do update set ps360_report_id = excluded.ps360_report_id
-                            where registrar_numbers_accessions.ps360_report_id is null
-                            """, [accession, reportId], prepare=True)
-                        await cur.execute(r"""
-                            insert into registrar_numbers (user_pacs, accession, overread)
-                            values (%s, %s, %s)
-                            on conflict (user_pacs, accession)
-                            do update set overread = excluded.overread
-                            where registrar_numbers.overread is null
-                            or registrar_numbers.overread > excluded.overread
-                            """, [user.pacs, accession, overread], prepare=True)
-                        if cur.rowcount > 0:
-                            logging.debug(
-                                f'{user.pacs} overread {accession} at {overread}')
+                overreads: list[tuple[str, int, datetime]] = []
+                overread_count = 0
+                async def known_reports(report_ids: list[int]) -> set[int]:
+                    await cur.execute(r"""
+                        select ps360_report_id from registrar_numbers_accessions
+                        where ps360_report_id = any(%s)
+                        """, [report_ids], prepare=True)
+                    return {report_id for report_id, in await cur.fetchall()}
+                async for reportId, accession, overread in ps360.overreads(user.ps360, scrape_from_datetime, scrape_to_datetime, known_reports):
+                    overreads.append((accession, reportId, overread))
+                    if len(overreads) >= STAGING_BATCH_SIZE:
+                        overread_count += await merge_overreads(cur, user.pacs, overreads)
+                        overreads = []
+                if overreads:
+                    overread_count += await merge_overreads(cur, user.pacs, overreads)
+                logging.info(f'{user.pacs}: {overread_count} overreads added or moved earlier')
             await cur.execute(r"""
                 select impression from registrar_numbers
                 where user_pacs = %s and impression is not null
@@ -286,83 +476,68 @@ class InteleBrowserClient(httpx.AsyncClient):
             logging.info(
                 f"Retrieving impressions data for {user.pacs} from {scrape_from_date} to {today}")
             await websocket_send_update(f"Retrieving impressions...", 2/RETRIEVE_STEPS)
-            response = await self.post(
-                self.APP_URL,
-                data={
-                    "service": "direct/1/AuditDetails/$Form",
-                    "sp": "S1",
-                    "Form1": "usernameFilter,$PropertySelection,patientIdFilter,studyDescriptionFilter,$PropertySelection$0,$Checkbox,$Checkbox$0,$Checkbox$1,$Checkbox$2,$Checkbox$3,$Checkbox$4,$Checkbox$5,$Checkbox$6,$Checkbox$7,$Checkbox$8,$Checkbox$9,$Checkbox$10,$Checkbox$11,$Checkbox$12,$Checkbox$13,$Checkbox$14,$Checkbox$15,$Checkbox$16,$Checkbox$17,$Checkbox$18,$Checkbox$19,$Checkbox$20,$Checkbox$21,$Checkbox$22,$Checkbox$23,$Checkbox$24,$Checkbox$25,$Checkbox$26,$Checkbox$27,$Checkbox$28,$Checkbox$29,$Checkbox$30,$Checkbox$31,$Checkbox$32,$Checkbox$33,$Checkbox$34,$Checkbox$35,$Checkbox$36,$Checkbox$37,$Checkbox$38,$Checkbox$39,$Checkbox$40,$Checkbox$41,$Checkbox$42,$Checkbox$43,$Checkbox$44,$Checkbox$45,$Checkbox$46,$Checkbox$47,$Checkbox$48,$Checkbox$49,$Checkbox$50,$Checkbox$51,$Submit",
-                    "usernameFilter": user.pacs,
-                    "$PropertySelection": "anyRole",
-                    "patientIdFilter": "",
-                    "studyDescriptionFilter": "",
-                    "$PropertySelection$0": f'{scrape_from_date.strftime("%Y/%m/%d")}:{today.strftime("%Y/%m/%d")}',
-                    "$Checkbox$2": "on",  # Add Emergency Impression
-                    "$Submit": "Update",
-                },
-            )
+            response = await self.search_audit(user.pacs, scrape_from_date, today)
+            restarted = False
             page_count = 0
             scraped_count = 0
             update_count = 0
+            tile_count = 0
+            tile_time = 0.0
+            semaphore = asyncio.Semaphore(IB_TILE_CONCURRENCY)
             while True:
                 root = html.fromstring(response.text)
-                for a in root.xpath("//a[@studyuid!=''][@actiontype][@date]"):
-                    uid = a.attrib['studyuid']
-                    timestamp = datetime.fromisoformat(
-                        a.attrib['date']).replace(tzinfo=TZ)
-                    await cur.execute(r"""
-                        select accession from registrar_numbers_accessions
-                        where pacs_audit_uid = %s
-                        """, [uid], prepare=True)
-                    if (row := await cur.fetchone()) is not None:
-                        accession, = row
-                        logging.debug(
-                            f"Fetched accession from database: {accession}")
-                    else:
-                        extra_response = await self.get(
-                            self.APP_URL,
-                            params={
-                                "service": "xtile/null/AuditDetails/$XTile$2", "sp": uid},
-                        )
-                        extra_root = etree.fromstring(extra_response.content)
-                        if (accession_node := extra_root.find("./sp[2]")) is not None:
-                            accession = accession_node.text
-                            logging.debug(
-                                f"Fetched accession from internet: {accession}")
-                            await cur.execute(r"""
-                                insert into registrar_numbers_accessions (accession, pacs_audit_uid)
-                                values (%s, %s)
-                                on conflict (accession)
-                                do update set pacs_audit_uid = excluded.pacs_audit_uid
-                                where registrar_numbers_accessions.pacs_audit_uid is null
-                                """, [accession, uid], prepare=True)
-                            scraped_count += 1
-                        else:
-                            logging.error(
-                                f'Error fetching accession for uid: {uid}')
-                            continue
-                    await cur.execute(r"""
-                        insert into registrar_numbers (user_pacs, accession, impression)
-                        values (%s, %s, %s)
-                        on conflict (user_pacs, accession)
-                        do update set impression = excluded.impression
-                        where registrar_numbers.impression is null
-                        or registrar_numbers.impression > excluded.impression
-                        """, [user.pacs, accession, timestamp], prepare=True)
-                    if cur.rowcount > 0:
-                        logging.debug(f"Updated database for {accession}")
-                        update_count += cur.rowcount
+                links = [
+                    (a.attrib['studyuid'], datetime.fromisoformat(a.attrib['date']).replace(tzinfo=TZ))
+                    for a in root.xpath("//a[@studyuid!=''][@actiontype][@date]")
+                ]
+                await cur.execute(r"""
+                    select pacs_audit_uid, accession from registrar_numbers_accessions
+                    where pacs_audit_uid = any(%s)
+                    """, [list({uid for uid, _ in links})], prepare=True)
+                known: dict[str, str] = {uid: accession for uid, accession in await cur.fetchall()}
+                logging.debug(f"Fetched {len(known)} accessions from database")
+                unresolved = list({uid for uid, _ in links if uid not in known})
+                tile_start = asyncio.get_running_loop().time()
+                scraped = dict(zip(unresolved, await asyncio.gather(*(self.fetch_accession(uid, semaphore) for uid in unresolved))))
+                if unresolved:
+                    tile_seconds = asyncio.get_running_loop().time() - tile_start
+                    tile_count += len(unresolved)
+                    tile_time += tile_seconds
+                    scraped_count += sum(accession is not None for accession in scraped.values())
+                    await websocket_send_update(
+                        f"Retrieving impressions: page {page_count + 1}, {scraped_count} new accessions ({len(unresolved) / tile_seconds:.1f} tiles/s)",
+                        2/RETRIEVE_STEPS,
+                    )
+                impressions: list[tuple[str, str | None, datetime]] = []
+                for uid, timestamp in links:
+                    if (accession := known.get(uid)) is not None:
+                        impressions.append((accession, None, timestamp))
+                    elif (accession := scraped[uid]) is not None:
+                        impressions.append((accession, uid, timestamp))
+                if impressions:
+                    update_count += await merge_impressions(cur, user.pacs, impressions)
                 if root.find(".//a[@name='nextPage']") is None:
                     logging.info(
-                        f"Scraped {page_count + 1} InteleBrowser audit pages and got {scraped_count} accessions ({update_count} database updates)")
+                        f"Scraped {page_count + 1} InteleBrowser audit pages and got {scraped_count} accessions ({update_count} database updates, "
+                        f"{tile_count} tiles at {tile_count / tile_time if tile_time else 0:.1f}/s)")
                     break
                 logging.info(
                     f"Processed page {page_count + 1}, fetching next page (total {scraped_count} accessions, {update_count} database updates)")
-                response = await self.post(
-                    f"http://{IB_HOST}/InteleBrowser/app",
-                    params={
-                        'service': 'direct/1/AuditDetails/auditDetailsTable.customPaginationControlTop.nextPage'},
-                )
+                try:
+                    response = await self.post(
+                        f"http://{IB_HOST}/InteleBrowser/app",
+                        params={
+                            'service': 'direct/1/AuditDetails/auditDetailsTable.customPaginationControlTop.nextPage'},
+                    )
+                except InteleBrowserSessionExpired:
+                    if restarted:
+                        raise
+                    # Pages already merged are merged again harmlessly, keeping the earliest impressions
+                    logging.warning('InteleBrowser session expired while paging, restarting the audit search from page 1')
+                    restarted = True
+                    response = await self.search_audit(user.pacs, scrape_from_date, today)
+                    page_count = 0
+                    continue
                 page_count += 1
             await cur.execute(r"""
                 select
@@ -429,3 +604,63 @@ class InteleBrowserClient(httpx.AsyncClient):
                                       if row['modality'] == 'XR' else 1, len(row['exams'])), axis=1, result_type='reduce')
         logging.info(f"Parsing complete")
         return df
+
+
+class InteleBrowserPool:
+    """
+    Logged-in InteleBrowser sessions, created lazily and reused across registrar numbers runs.
+
+    A session is checked out exclusively, so the audit search and its pagination state on the
+    server belong to one run at a time; each run starts with a fresh search. Sessions that
+    raise an HTTP error or are cancelled mid-request are logged out and discarded rather than returned.
+    """
+
+    def __init__(self, size: int):
+        self._semaphore = asyncio.Semaphore(size)
+        self._idle: list[InteleBrowserClient] = []
+
+    @asynccontextmanager
+    async def checkout(self) -> AsyncIterator[InteleBrowserClient]:
+        async with self._semaphore:
+            if self._idle:
+                client = self._idle.pop()
+            else:
+                client = InteleBrowserClient(timeout=None, transport=MeteredTransport('intelebrowser'))
+                try:
+                    await client.login()
+                except BaseException:
+                    await client.aclose()
+                    raise
+            try:
+                yield client
+            except (httpx.HTTPError, asyncio.CancelledError):
+                # A cancelled run may have left a request or the search half done
+                await self._discard(client)
+                raise
+            except BaseException:
+                self._idle.append(client)
+                raise
+            else:
+                self._idle.append(client)
+
+    @staticmethod
+    async def _discard(client: InteleBrowserClient):
+        """Log out, so the server-side login isn't left behind, then close."""
+        try:
+            await asyncio.wait_for(client.logout(), IB_LOGOUT_TIMEOUT)
+        except (httpx.HTTPError, TimeoutError) as e:
+            logging.warning(f'Error logging out of InteleBrowser: {e!r}')
+        finally:
+            await client.aclose()
+
+    async def close(self):
+        while self._idle:
+            await self._discard(self._idle.pop())
+
+
+ib_pool = InteleBrowserPool(IB_POOL_SIZE)
+
+
+@app.after_serving
+async def close_ib_pool():
+    await ib_pool.close()
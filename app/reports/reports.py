@@ -1,31 +1,207 @@
 from . import app, TZ, HOLIDAYS
-from quart import request, render_template
-from ..database import comrad_pool
+from quart import request, render_template, stream_template, stream_with_context
+from ..database import reports_pool
 from psycopg.abc import Query, Params
+from collections import OrderedDict, deque
+from dataclasses import dataclass
 from datetime import date, datetime
+from os import environ
+from io import StringIO
+from statistics import median
+from typing import Any, AsyncIterable, AsyncIterator, Hashable, Iterable
+import csv
 import time
 
+# Rows fetched per round trip from the server-side cursor
+FETCH_SIZE = int(environ.get('REPORTS_FETCH_SIZE', 2000))
+# Streams stop after this many rows or seconds, so one download can't hold a reports connection indefinitely
+STREAM_MAX_ROWS = int(environ.get('REPORTS_STREAM_MAX_ROWS', 200000))
+STREAM_MAX_SECONDS = float(environ.get('REPORTS_STREAM_MAX_SECONDS', 300))
+# Bytes of rendered output gathered before each chunk is sent
+CHUNK_SIZE = 64 * 1024
+# Results with more rows than this are streamed but not cached
+CACHE_MAX_ROWS = int(environ.get('REPORTS_CACHE_MAX_ROWS', 20000))
+CACHE_SIZE = int(environ.get('REPORTS_CACHE_SIZE', 64))
+# Reports covering days that are over can't change, today's are still filling in
+PAST_TTL = float(environ.get('REPORTS_CACHE_PAST_SECONDS', 24 * 60 * 60))
+TODAY_TTL = float(environ.get('REPORTS_CACHE_TODAY_SECONDS', 60))
+HISTORY_SIZE = 50
+
+@dataclass(frozen=True, slots=True)
+class CachedTable:
+    headers: list[str]
+    rows: list[tuple]
+    execution_time: float
+    generated: datetime
+    expires: float
+
+@dataclass(frozen=True, slots=True)
+class Execution:
+    at: datetime
+    execution_time: float
+    rows: int
+
+class TableCache(OrderedDict[Hashable, CachedTable]):
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def lookup(self, key: Hashable) -> CachedTable | None:
+        if (table := self.get(key)) is None:
+            return None
+        if table.expires < time.monotonic():
+            del self[key]
+            return None
+        self.move_to_end(key)
+        return table
+
+    def store(self, key: Hashable, table: CachedTable):
+        self[key] = table
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+table_cache = TableCache(CACHE_SIZE)
+
+# Recent uncached executions per report, newest last
+history: dict[str, deque[Execution]] = {}
+
+def ttl_for(d: date) -> float:
+    return PAST_TTL if d < datetime.now(tz=TZ).date() else TODAY_TTL
+
+def cache_key(report: str, params: Params | None) -> Hashable:
+    if isinstance(params, dict):
+        return report, tuple(sorted(params.items()))
+    return report, tuple(params) if params is not None else None
+
+def history_summary(executions: Iterable[Execution]) -> dict[str, Any]:
+    executions = list(executions)
+    times = [execution.execution_time for execution in executions]
+    return dict(
+        runs=len(executions),
+        last=executions[-1] if executions else None,
+        median=median(times) if times else None,
+        max=max(times, default=None),
+    )
+
 @app.get('/reports/')
 async def get_reports():
     links: list[tuple[str, str]] = [
         ('FFS reports', 'ffs'),
     ]
-    return await render_template('reports/reports.jinja', links=links)
-
-async def get_table(title: str, query: Query, params: Params | None = None):
-    start_time = time.perf_counter()
-    async with comrad_pool.connection() as conn:
-        async with await conn.execute(query, params) as cur:
-            headers = [desc.name for desc in cur.description] # pyright: ignore[reportOptionalIterable]
-            rows = await cur.fetchall()
     return await render_template(
+        'reports/reports.jinja',
+        links=links,
+        history={report: history_summary(history.get(report, ())) for _, report in links},
+    )
+
+async def buffered(chunks: AsyncIterable[str]) -> AsyncIterator[str]:
+    """Coalesce Jinja's many small fragments into fewer, larger writes."""
+    buffer: list[str] = []
+    size = 0
+    async for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= CHUNK_SIZE:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+async def render_table(title: str, headers: list[str], rows: AsyncIterable, summary: dict, params: Params | None, csv_format: bool) -> AsyncIterator[str]:
+    if csv_format:
+        out = StringIO()
+        writer = csv.writer(out)
+        writer.writerow(headers)
+        async for row in rows:
+            writer.writerow(row)
+            if out.tell() >= CHUNK_SIZE:
+                yield out.getvalue()
+                out.seek(0)
+                out.truncate()
+        if summary.get('truncated'):
+            writer.writerow([f"Truncated after {summary['count']} rows"])
+        yield out.getvalue()
+        return
+    async for chunk in buffered(await stream_template(
         'reports/table.jinja',
         title = title,
         headers = headers,
         rows = rows,
-        execution_time = time.perf_counter() - start_time,
+        summary = summary,
         params = params,
-    )
+    )):
+        yield chunk
+
+async def stream_table(report: str, title: str, query: Query, params: Params | None, ttl: float, csv_format: bool) -> AsyncIterator[str]:
+    key = cache_key(report, params)
+    if ttl > 0 and (cached := table_cache.lookup(key)) is not None:
+        async def cached_rows():
+            for row in cached.rows:
+                yield row
+        summary = dict(count=len(cached.rows), execution_time=cached.execution_time, cached=cached.generated, truncated=False)
+        async for chunk in render_table(title, cached.headers, cached_rows(), summary, params, csv_format):
+            yield chunk
+        return
+    async with reports_pool.connection() as conn:
+        async with conn.cursor(name='report') as cur:
+            # execution_time covers the query and fetches only, not rendering or the client's download
+            start_time = time.perf_counter()
+            await cur.execute(query, params)
+            execution_time = time.perf_counter() - start_time
+            headers = [desc.name for desc in cur.description] # pyright: ignore[reportOptionalIterable]
+            # The caption is rendered after the rows, so count them as they stream past
+            summary = dict(count=0, execution_time=0.0, cached=None, truncated=False)
+            deadline = time.monotonic() + STREAM_MAX_SECONDS
+            async def rows():
+                nonlocal execution_time
+                kept: list[tuple] | None = [] if ttl > 0 else None
+                while True:
+                    fetch_start = time.perf_counter()
+                    batch = await cur.fetchmany(FETCH_SIZE)
+                    execution_time += time.perf_counter() - fetch_start
+                    if not batch:
+                        break
+                    for row in batch:
+                        if summary['count'] >= STREAM_MAX_ROWS or time.monotonic() > deadline:
+                            # Partial results are neither cached nor recorded in the history
+                            summary['truncated'] = True
+                            return
+                        summary['count'] += 1
+                        if kept is not None:
+                            if len(kept) < CACHE_MAX_ROWS:
+                                kept.append(row)
+                            else:
+                                kept = None
+                        yield row
+                summary['execution_time'] = execution_time
+                now = datetime.now(tz=TZ)
+                history.setdefault(report, deque(maxlen=HISTORY_SIZE)).append(Execution(now, execution_time, summary['count']))
+                if kept is not None:
+                    table_cache.store(key, CachedTable(headers, kept, execution_time, now, time.monotonic() + ttl))
+            async for chunk in render_table(title, headers, rows(), summary, params, csv_format):
+                yield chunk
+
+async def get_table(report: str, title: str, query: Query, params: Params | None = None, ttl: float = 0):
+    """
+    Stream a report as an HTML table, or as CSV with ?format=csv.
+
+    Complete results of up to CACHE_MAX_ROWS rows are cached for `ttl` seconds
+    under (report, params); ?refresh bypasses the cache.
+    """
+    if 'refresh' in request.args:
+        table_cache.pop(cache_key(report, params), None)
+    if request.args.get('format') == 'csv':
+        filename = title.lower().replace(' ', '-')
+        if isinstance(params, dict) and 'date' in params:
+            filename += f"-{params['date']}"
+        return stream_with_context(stream_table)(report, title, query, params, ttl, True), 200, {
+            'Content-Type': 'text/csv; charset=utf-8',
+            'Content-Disposition': f'attachment; filename="{filename}.csv"',
+        }
+    return stream_with_context(stream_table)(report, title, query, params, ttl, False), 200, {
+        'Content-Type': 'text/html; charset=utf-8',
+    }
 
 @app.get('/reports/ffs')
 async def get_report_ffs():
@@ -34,7 +210,7 @@ async def get_report_ffs():
     except:
         d = datetime.now(tz=TZ).date()
     holiday = d in HOLIDAYS
-    return await get_table('FFS reports', r'''
+    return await get_table('ffs', 'FFS reports', r'''
 select
     or_accession_no as "Accession",
     case when or_ex_type = 'OD' then 'XR' else or_ex_type end as "Modality",
@@ -56,4 +232,4 @@ where ct_dor between %(date)s + '06:00:00'::time and %(date)s + '23:00:00'::time
     and ct_staff_serial not in (3725, 8057, 7870, 6692)
     and site.sl_aux1 = 'CDHB'
     and ce_site NOT IN ('HAN', 'KAIK', 'CARD')
-order by st_surname, ct_dor''', dict(date=d, holiday=holiday))
\ No newline at end of file
+order by st_surname, ct_dor''', dict(date=d, holiday=holiday), ttl_for(d))
\ No newline at end of file
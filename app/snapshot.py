@@ -0,0 +1,156 @@
+import asyncio
+import hashlib
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable
+import orjson
+
+
+class Subscription:
+    """
+    Queue of serialized messages for one streaming client.
+
+    A client that falls too far behind has its backlog dropped and is sent the
+    full snapshot again, so a slow display can never hold memory hostage.
+    """
+
+    def __init__(self, snapshot: 'Snapshot', maxsize: int = 16):
+        self._snapshot = snapshot
+        self._queue: asyncio.Queue[str | None] = asyncio.Queue(maxsize)
+        self._queue.put_nowait(None) # start with the full snapshot
+
+    def push(self, message: str | None):
+        try:
+            self._queue.put_nowait(message)
+        except asyncio.QueueFull:
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._queue.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        message = await self._queue.get()
+        return self._snapshot.full_message() if message is None else message
+
+
+class Snapshot:
+    """
+    In-memory copy of an expensive payload, refreshed by a background task.
+
+    Readers share whatever the last refresh produced instead of querying the
+    databases themselves. The ETag is derived from the payload, so it only
+    changes when the data does.
+
+    If a `diff` function is given, streaming clients can subscribe to receive the
+    full payload once and then only the differences between consecutive refreshes.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        loader: Callable[[], Awaitable[Any]],
+        interval: float,
+        diff: Callable[[Any, Any], dict | None] | None = None,
+    ):
+        self.name = name
+        self.interval = interval
+        self.data: Any = None
+        self.etag: str | None = None
+        self.generated: float | None = None
+        self._loader = loader
+        self._diff = diff
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._subscribers: set[Subscription] = set()
+        self._full_message: tuple[str, str] | None = None
+
+    @property
+    def age(self) -> float | None:
+        return None if self.generated is None else time.time() - self.generated
+
+    async def refresh(self):
+        async with self._lock:
+            await self._refresh()
+
+    async def _refresh(self):
+        data = await self._loader()
+        etag = hashlib.sha1(orjson.dumps(data)).hexdigest()
+        previous, previous_etag = self.data, self.etag
+        self.etag = etag
+        self.data = data
+        self.generated = time.time()
+        if self._subscribers and previous is not None and etag != previous_etag:
+            if self._diff is None:
+                message = None # no diff available, resend the full snapshot
+            elif (delta := self._diff(previous, data)) is not None:
+                message = orjson.dumps(dict(type='delta', etag=etag, generated=int(self.generated), **delta)).decode()
+            else:
+                return
+            for subscription in self._subscribers:
+                subscription.push(message)
+
+    def full_message(self) -> str:
+        if self._full_message is None or self._full_message[0] != self.etag:
+            self._full_message = (self.etag, orjson.dumps(dict( # pyright: ignore[reportAttributeAccessIssue]
+                type='snapshot',
+                etag=self.etag,
+                generated=int(self.generated), # pyright: ignore[reportArgumentType]
+                data=self.data,
+            )).decode())
+        return self._full_message[1]
+
+    @asynccontextmanager
+    async def subscribe(self) -> AsyncIterator[Subscription]:
+        await self.get()
+        subscription = Subscription(self)
+        self._subscribers.add(subscription)
+        try:
+            yield subscription
+        finally:
+            self._subscribers.discard(subscription)
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    async def get(self) -> 'Snapshot':
+        if self.data is None:
+            async with self._lock:
+                if self.data is None:
+                    await self._refresh()
+        return self
+
+    async def _run(self):
+        if self.age is not None and self.age < self.interval:
+            await asyncio.sleep(self.interval - self.age)
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logging.exception(f'Error refreshing {self.name} snapshot')
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name=f'{self.name} snapshot')
+            logging.info(f'Refreshing {self.name} snapshot every {self.interval} seconds')
+
+    async def stop(self):
+        """
+        Stop refreshing and forget the payload, so a later reader never sees stale data.
+
+        The payload is kept while anyone is still subscribed, including a subscriber that
+        arrived while the refresh task was being cancelled.
+        """
+        if (task := self._task) is not None:
+            self._task = None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if not self._subscribers:
+            self.data = self.etag = self.generated = None
@@ -1,8 +1,10 @@
 from typing import LiteralString
+from os import environ
 from . import app, TZ
-from ..database import local_pool, comrad_pool, phy_sch_connection
+from ..database import local_pool, comrad_pool, phy_sch_pool
+from ..snapshot import Snapshot
 from psycopg.rows import dict_row
-from quart import render_template
+from quart import render_template, request, websocket, Response
 from datetime import datetime
 
 users_query: LiteralString = r"""
@@ -88,6 +90,7 @@ declare
     @today int = year(CURRENT_TIMESTAMP) * 10000 + month(CURRENT_TIMESTAMP) * 100 + day(CURRENT_TIMESTAMP),
     @current_time int = 100 * DATEPART(hour, CURRENT_TIMESTAMP) + DATEPART(minute, CURRENT_TIMESTAMP)
 select
+    Employee.Abbr as physch,
     ShiftName as shift,
     FORMAT(Shift.StartTime / 100 % 24, '00') + ':' + format(Shift.StartTime % 100, '00') as start,
     FORMAT(Shift.EndTime / 100 % 24, '00') + ':' + format(Shift.EndTime % 100, '00') as 'end',
@@ -95,10 +98,24 @@ select
 from SchedData
     join Employee on SchedData.EmployeeID = Employee.EmployeeID
     join Shift on SchedData.ShiftID = Shift.ShiftID
-where AssignDate = @today and Employee.Abbr = %s
-order by Shift.StartTime, Shift.EndTime, Shift.DisplayOrder, Shift.ShiftName, Shift.ShiftID
+where AssignDate = @today and Employee.Abbr in %s
+order by Employee.Abbr, Shift.StartTime, Shift.EndTime, Shift.DisplayOrder, Shift.ShiftName, Shift.ShiftID
 """
 
+async def fetch_rosters(physch_codes: set[str]) -> dict[str, list[dict]]:
+    """Today's shifts for each PhySch abbreviation, fetched in a single round trip.
+
+    Keys are upper-cased, as SQL Server matches the abbreviations case-insensitively.
+    """
+    if not physch_codes:
+        return {}
+    async with phy_sch_pool.connection() as conn:
+        rows = await conn.fetchall(phys_sched_query, (tuple(physch_codes),), as_dict=True)
+    rosters: dict[str, list[dict]] = {}
+    for row in rows:
+        rosters.setdefault(row.pop("physch").upper(), []).append(row)
+    return rosters
+
 available_desks_query: LiteralString = r"""
 with logged_on_users as (
     select first_name || ' ' || last_name AS full_name, pacs_presence, key as computer_name, value as logon from users, jsonb_each(windows_logons)
@@ -116,20 +133,14 @@ having bool_and(pacs_presence = 'Offline') is not false
 order by sort_order
 """
 
-@app.get('/wally_data')
-async def wally_data():
+async def load_wally_data():
     async with local_pool.connection() as coolify_conn:
         async with coolify_conn.cursor(row_factory=dict_row) as coolify_cur:
             await coolify_cur.execute(users_query, prepare=True)
-            online_users = {}
-            with phy_sch_connection() as phys_sched_conn:
-                with phys_sched_conn.cursor(as_dict=True) as phys_sched_cur:
-                    async for user in coolify_cur:
-                        phys_sched_cur.execute(phys_sched_query, (user["physch"],))
-                        user["roster"] = phys_sched_cur.fetchall()
-                        online_users[user.pop("ris")] = user
+            online_users = {user.pop("ris"): user async for user in coolify_cur}
             await coolify_cur.execute(available_desks_query, prepare=True)
             available_desks = await coolify_cur.fetchall()
+    rosters = await fetch_rosters({user["physch"] for user in online_users.values() if user["physch"] is not None})
     async with comrad_pool.connection() as conn:
         async with await conn.execute(ris_query, ([ris for ris in online_users.keys()],), prepare=True) as cur:
             ris_data = {ris:dict(
@@ -137,6 +148,7 @@ async def wally_data():
                 last_triage=last_triage,
             ) async for ris, last_report, last_triage in cur}
     for ris, user in online_users.items():
+        user["roster"] = rosters.get(user["physch"].upper(), []) if user["physch"] is not None else []
         user.update(ris_data[ris])
         timestamps = [timestamp for timestamp in (
             user["last_report"],
@@ -151,6 +163,55 @@ async def wally_data():
         available_desks=available_desks,
     )
 
+def diff_keyed(old: dict, new: dict) -> dict:
+    """Entries that were added or changed, with removed keys mapped to None."""
+    changes = {key: value for key, value in new.items() if old.get(key) != value}
+    changes.update({key: None for key in old.keys() - new.keys()})
+    return changes
+
+def diff_wally_data(old: dict, new: dict) -> dict | None:
+    old_desks = {desk["computer"]: desk for desk in old["available_desks"]}
+    new_desks = {desk["computer"]: desk for desk in new["available_desks"]}
+    delta = {}
+    if users := diff_keyed(old["online_users"], new["online_users"]):
+        delta["online_users"] = users
+        if list(old["online_users"]) != list(new["online_users"]):
+            delta["user_order"] = list(new["online_users"])
+    if desks := diff_keyed(old_desks, new_desks):
+        delta["available_desks"] = desks
+        if list(old_desks) != list(new_desks):
+            delta["desk_order"] = list(new_desks)
+    return delta or None
+
+snapshot = Snapshot('wally', load_wally_data, float(environ.get('WALLY_REFRESH_SECONDS', 15)), diff_wally_data)
+
+@app.before_serving
+async def start_snapshot():
+    snapshot.start()
+
+@app.after_serving
+async def stop_snapshot():
+    await snapshot.stop()
+
+def conditional(response: Response, etag: str) -> Response:
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    return response
+
+@app.get('/wally_data')
+async def wally_data():
+    await snapshot.get()
+    etag = f'wally-{snapshot.etag}'
+    if request.if_none_match.contains_weak(etag):
+        return conditional(Response('', status=304), etag)
+    return conditional(app.json.response(dict(
+        **snapshot.data,
+        snapshot=dict(
+            generated=int(snapshot.generated), # pyright: ignore[reportArgumentType]
+            age=round(snapshot.age, 1), # pyright: ignore[reportArgumentType]
+        ),
+    )), etag)
+
 def format_iso8601(posix: int) -> str:
     return datetime.fromtimestamp(posix, TZ).isoformat()
 
@@ -188,6 +249,18 @@ app.jinja_env.filters['presence_icon_class'] = presence_icon_class
 async def wally():
     return await render_template('wally.jinja')
 
+@app.websocket('/wally/stream')
+async def wally_stream():
+    # First message is {type: 'snapshot', data}, then {type: 'delta', online_users, available_desks}
+    # keyed by RIS code / computer name, where a null value means the entry has gone.
+    async with snapshot.subscribe() as updates:
+        async for message in updates:
+            await websocket.send(message)
+
 @app.get('/locator-data')
 async def locator():
-    return await render_template('locator-data.jinja', data = await wally_data())
\ No newline at end of file
+    await snapshot.get()
+    etag = f'locator-{snapshot.etag}'
+    if request.if_none_match.contains_weak(etag):
+        return conditional(Response('', status=304), etag)
+    return conditional(Response(await render_template('locator-data.jinja', data=snapshot.data)), etag)
\ No newline at end of file
@@ -0,0 +1,4 @@
+-- Local database (DB_CONN). Apply once, before deploying the matching release:
+--   psql "$DB_CONN" -f migrations/0001_triage_log_match_type.sql
+-- Records whether autotriage matched a label exactly or approximately.
+alter table triage_log add column if not exists match_type text;
@@ -0,0 +1,27 @@
+-- Local database (DB_CONN). Apply once, before deploying the matching release:
+--   psql "$DB_CONN" -f migrations/0002_ffs_facts.sql
+-- Per-report FFS facts for closed days, copied nightly from ComRad, and the days materialised so far.
+create table if not exists ffs_facts (
+    day date not null,
+    user_code text not null,
+    user_firstnames text,
+    user_surname text,
+    radiologist boolean not null,
+    nz_time timestamp not null,
+    nz_after_hours boolean not null,
+    nz_weekend boolean not null,
+    nz_holiday boolean not null,
+    or_accession_no text,
+    examtype text,
+    ce_description text,
+    imaged timestamp,
+    ce_site text,
+    verifier text,
+    prelim_reporter text
+);
+create index if not exists ffs_facts_day_user_code on ffs_facts (day, user_code);
+create table if not exists ffs_facts_days (
+    day date primary key,
+    reports int not null,
+    refreshed timestamptz not null default now()
+);
@@ -0,0 +1,6 @@
+-- Local database (DB_CONN). Apply once, before deploying the matching release:
+--   psql "$DB_CONN" -f migrations/0003_ffs_body_parts_machine_derived.sql
+-- Flags body part counts classified by the parts parser rather than by hand, for review.
+alter table ffs_body_parts add column if not exists machine_derived boolean not null default false;
+-- Lets automatic classifications use on conflict do nothing; de-duplicate names first if this fails.
+create unique index if not exists ffs_body_parts_name on ffs_body_parts (name);